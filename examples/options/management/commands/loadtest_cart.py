@@ -0,0 +1,173 @@
+import sys
+import threading
+from decimal import Decimal
+from optparse import make_option
+from time import time
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection
+from django.db.models import Sum
+from django.test.client import Client
+
+from options_product.models import Product, ProductVariation
+from plata.product.stock.models import StockTransaction
+from plata.shop.models import TaxClass
+
+
+CHECKOUT_DATA = {
+    '_checkout': 1,
+    'order-billing_company': u'Load Test',
+    'order-billing_first_name': u'Hans',
+    'order-billing_last_name': u'Muster',
+    'order-billing_address': u'Musterstrasse 42',
+    'order-billing_zip_code': u'8042',
+    'order-billing_city': u'Beispielstadt',
+    'order-billing_country': u'CH',
+    'order-shipping_same_as_billing': True,
+    'order-email': 'loadtest@example.com',
+    'order-currency': 'CHF',
+    }
+
+
+def percentile(values, percent):
+    """
+    Returns the ``percent`` percentile of the sorted list ``values`` using
+    the nearest rank method
+    """
+    if not values:
+        return 0.0
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class Command(NoArgsCommand):
+    help = ('Runs concurrent add-to-cart and checkout flows against the product'
+        ' detail view and reports throughput, latencies and oversold items.'
+        ' Creates a new product; use a scratch database, not a production one.'
+        ' SQLite serializes all writes, use PostgreSQL or MySQL to measure'
+        ' contention realistically.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', action='store', dest='workers', type='int',
+            default=10, help='Number of concurrent clients. Defaults to 10.'),
+        make_option('--flows', action='store', dest='flows', type='int',
+            default=10, help='Number of flows per client. Defaults to 10.'),
+        make_option('--stock', action='store', dest='stock', type='int',
+            default=50, help='Items in stock at the start. Defaults to 50.'),
+        make_option('--quantity', action='store', dest='quantity', type='int',
+            default=1, help='Items added to the cart per flow. Defaults to 1.'),
+        make_option('--no-checkout', action='store_false', dest='checkout',
+            default=True, help='Only add items to carts, do not check out.'),
+        )
+
+    def handle_noargs(self, **options):
+        if options.get('workers') < 1 or options.get('flows') < 1:
+            raise CommandError('--workers and --flows have to be positive.')
+
+        variation = self.create_product(options.get('stock'))
+        url = variation.product.get_absolute_url()
+
+        lock = threading.Lock()
+        results = {'add': [], 'flow': [], 'added': 0, 'completed': 0, 'errors': 0}
+
+        def record(key, value):
+            lock.acquire()
+            try:
+                if isinstance(results[key], list):
+                    results[key].append(value)
+                else:
+                    results[key] += value
+            finally:
+                lock.release()
+
+        def worker():
+            try:
+                for idx in range(options.get('flows')):
+                    try:
+                        self.flow(Client(), url, options, record)
+                    except Exception, e:
+                        record('errors', 1)
+                        sys.stderr.write('%s: %s\n' % (e.__class__.__name__, e))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker)
+            for idx in range(options.get('workers'))]
+
+        start = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time() - start
+
+        self.report(variation, options, results, duration)
+
+    def create_product(self, stock):
+        tax_class, created = TaxClass.objects.get_or_create(
+            name='Load test', defaults={'rate': Decimal('7.60')})
+
+        slug = 'loadtest-%d' % (time() * 1000)
+        product = Product.objects.create(name=slug, slug=slug)
+        product.create_variations()
+        product.prices.create(currency='CHF', tax_class=tax_class,
+            _unit_price=Decimal('10.00'), tax_included=True)
+
+        variation = product.variations.get()
+        variation.stock_transactions.create(type=StockTransaction.PURCHASE,
+            change=stock)
+        return variation
+
+    def flow(self, client, url, options, record):
+        start = time()
+        response = client.post(url, {'quantity': options.get('quantity')})
+        record('add', time() - start)
+        if response.status_code != 302:
+            # The form has been redisplayed, f.e. because stock ran out
+            return
+        record('added', 1)
+
+        if options.get('checkout'):
+            client.get('/checkout/')
+            client.post('/checkout/', CHECKOUT_DATA)
+            client.post('/discounts/', {'proceed': 'True'})
+            response = client.post('/confirmation/', {
+                'terms_and_conditions': True,
+                'payment_method': 'plata.payment.modules.cod',
+                })
+            if response.status_code == 302:
+                record('completed', 1)
+
+        record('flow', time() - start)
+
+    def report(self, variation, options, results, duration):
+        sold = -(StockTransaction.objects.filter(product=variation,
+            type=StockTransaction.SALE).aggregate(items=Sum('change'))['items'] or 0)
+        variation = ProductVariation.objects.get(pk=variation.pk)
+        total = options.get('workers') * options.get('flows')
+
+        lines = [
+            'Product variation: %s (%s)' % (variation.sku, variation.pk),
+            'Flows: %s in %.2fs, %.1f flows/s, %.1f add-to-cart requests/s' % (
+                total, duration, total / duration, len(results['add']) / duration),
+            'Added to cart: %s, checked out: %s, errors: %s' % (
+                results['added'], results['completed'], results['errors']),
+            ]
+
+        for key, name in (('add', 'Add to cart'), ('flow', 'Complete flow')):
+            values = sorted(results[key])
+            lines.append('%s latency (ms): p50 %.1f, p90 %.1f, p99 %.1f, max %.1f' % (
+                name,
+                percentile(values, 50) * 1000,
+                percentile(values, 90) * 1000,
+                percentile(values, 99) * 1000,
+                (values and values[-1] or 0) * 1000))
+
+        lines.extend([
+            'Stock: %s initially, %s sold, %s in stock, %s reserved' % (
+                options.get('stock'), sold, variation.items_in_stock,
+                variation.items_reserved),
+            'Oversold: %s' % max(sold - options.get('stock'), 0),
+            ])
+
+        sys.stdout.write('\n'.join(lines) + '\n')
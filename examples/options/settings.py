@@ -76,6 +76,7 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'options_product.caching.DeferredInvalidationMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -110,6 +111,7 @@ INSTALLED_APPS = (
     'options_product.producer',
 
     'plata.product.stock',
+    'options_product.snapshots',
     'plata.shop',
 
     'options',
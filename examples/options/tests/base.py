@@ -1,6 +1,8 @@
 from datetime import date
 from decimal import Decimal
 
+from django.conf import settings
+from django.db import connection
 from django.test import TestCase
 from django.contrib.auth.models import AnonymousUser, User
 
@@ -61,6 +63,24 @@ class PlataTest(TestCase):
             raise
         raise Exception, '%s did not raise %s' % (fn, exception)
 
+    def assertQueryCount(self, num, fn, *args, **kwargs):
+        """
+        Asserts that calling ``fn`` issues exactly ``num`` database queries
+        and returns the return value of ``fn``
+        """
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        offset = len(connection.queries)
+        try:
+            value = fn(*args, **kwargs)
+            queries = connection.queries[offset:]
+        finally:
+            settings.DEBUG = old_debug
+
+        self.assertEqual(len(queries), num, '%s queries executed, %s expected:\n%s' % (
+            len(queries), num, u'\n'.join(q['sql'] for q in queries)))
+        return value
+
     def setUp(self):
         plata.settings.PLATA_PRICE_INCLUDES_TAX = True
 
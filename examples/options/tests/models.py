@@ -1,14 +1,15 @@
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from decimal import Decimal
 import StringIO
 
 from django.core.exceptions import ValidationError
+from django.utils import simplejson
 
 from pdfdocument.document import PDFDocument
 
 import plata
 from plata.discount.models import Discount
-from options_product.models import Product, \
+from options_product.models import Option, OptionGroup, Product, \
     ProductVariation, Category, ProductPrice
 from plata.product.stock.models import Period, StockTransaction
 import plata.reporting.order
@@ -1025,3 +1026,1258 @@ class ModelTest(PlataTest):
         # discounted value
         self.assertAlmostEqual(order.total, Decimal('80.00'))
         self.assertAlmostEqual(order.subtotal, Decimal('80.00') / Decimal('1.076'))
+
+    def test_28_bulk_prices(self):
+        """Test resolving prices of many products at once"""
+        p1 = self.create_product()
+        p2 = self.create_product()
+        p3 = self.create_product()
+        p3.prices.filter(currency='EUR').delete()
+
+        # Only the uncached products' prices are fetched, in a single query
+        p1.get_prices()
+        p2.flush_price_cache()
+        p3.flush_price_cache()
+        products = self.assertQueryCount(2, lambda: list(Product.objects.with_prices()))
+
+        self.assertEqual(len(products), 3)
+        self.assertQueryCount(1, lambda: list(Product.objects.with_prices()))
+
+        def prices():
+            return [(p.get_price(currency='CHF').unit_price, p.in_sale('CHF'),
+                p.in_sale('EUR')) for p in products]
+
+        self.assertEqual(self.assertQueryCount(0, prices), [
+            (Decimal('79.90'), True, False)] * 3)
+        self.assertEqual(dict(products[2].get_prices()).get('EUR'), None)
+        self.assertEqual(dict(products[1].get_prices())['EUR']['normal'].pk,
+            dict(p2.get_prices())['EUR']['normal'].pk)
+
+        products[0].flush_price_cache()
+        self.assertEqual(self.assertQueryCount(1, products[0].get_prices),
+            p1.get_prices())
+
+    def test_29_in_sale_queryset(self):
+        """Test the SQL version of the in sale check"""
+        p1 = self.create_product()
+        p2 = self.create_product()
+        p3 = self.create_product()
+
+        # A normal price newer than the sale price ends the sale
+        p2.prices.create(
+            currency='CHF',
+            tax_class=self.tax_class,
+            _unit_price=Decimal('89.90'),
+            tax_included=True,
+            valid_from=date.today(),
+            )
+        p2.prices.filter(is_sale=True).update(valid_from=date(2010, 1, 1))
+        p2.flush_price_cache()
+
+        # Sale prices without a normal price are in sale too
+        p3.prices.filter(currency='EUR').update(is_sale=True)
+        p3.flush_price_cache()
+
+        for currency in ('CHF', 'EUR', 'CAD'):
+            self.assertEqual(
+                set(Product.objects.active().in_sale(currency)),
+                set(p for p in Product.objects.all() if p.in_sale(currency)))
+
+        self.assertEqual(list(Product.objects.in_sale('CHF').order_by('id')), [p1, p3])
+        self.assertEqual(list(Product.objects.in_sale('EUR')), [p3])
+        self.assertEqual(Product.objects.in_sale('CAD').count(), 0)
+
+    def test_30_price_cache_timeout(self):
+        """Test price cache entries expire when the active prices change"""
+        from options_product.models import price_cache_timeout, PRICE_CACHE_TIMEOUT
+
+        product = self.create_product()
+        now = datetime(2010, 6, 1, 23, 0)
+
+        self.assertEqual(price_cache_timeout([], now), PRICE_CACHE_TIMEOUT)
+
+        price = product.prices.create(
+            currency='CHF',
+            tax_class=self.tax_class,
+            _unit_price=Decimal('69.90'),
+            tax_included=True,
+            valid_from=date(2010, 6, 1),
+            valid_until=date(2010, 6, 3),
+            )
+        # Prices stay valid until the end of valid_until
+        self.assertEqual(price_cache_timeout([price], now), 3600 + 2 * 86400 + 1)
+
+        price.valid_from = date(2010, 6, 2)
+        self.assertEqual(price_cache_timeout([price], now), 3600 + 1)
+
+        price.valid_from = date(2011, 1, 1)
+        price.valid_until = None
+        self.assertEqual(price_cache_timeout([price], now), PRICE_CACHE_TIMEOUT)
+
+        # Prices which become active later are not active yet
+        price.valid_from = date.today() + timedelta(days=1)
+        price.save()
+        self.assertAlmostEqual(product.get_price(currency='CHF').unit_price,
+            Decimal('79.90'))
+
+    def test_31_local_price_cache(self):
+        """Test the process-local price cache tier"""
+        from options_product.caching import LocalCache, price_cache
+
+        local = LocalCache(max_entries=2, timeout=10)
+        local.set('a', 1)
+        local.set('b', 2)
+        self.assertEqual(local.get('a'), 1)
+        local.set('c', 3)
+        # b has been used least recently
+        self.assertEqual(local.get('b'), None)
+        self.assertEqual((local.get('a'), local.get('c')), (1, 3))
+        self.assertEqual(len(local), 2)
+
+        local.set('d', 4, timeout=-1)
+        self.assertEqual(local.get('d'), None)
+
+        product = self.create_product()
+        price_cache.reset_stats()
+
+        product.get_prices()
+        for i in range(3):
+            Product.objects.get(pk=product.pk).get_price(currency='CHF')
+
+        self.assertEqual(price_cache.stats, {
+            'local_hits': 3, 'shared_hits': 0, 'misses': 1, 'stale_hits': 0})
+
+        product.flush_price_cache()
+        price_cache.local.clear()
+        product.get_prices()
+        self.assertEqual(price_cache.stats['misses'], 2)
+        price_cache.local.clear()
+        product.get_prices()
+        self.assertEqual(price_cache.stats['shared_hits'], 1)
+
+    def test_32_cached_price(self):
+        """Test the compact price records stored in the price cache"""
+        import pickle
+        from options_product.models import CachedPrice
+
+        product = self.create_product()
+        order = self.create_order()
+
+        price = product.get_price(currency='CHF')
+        self.assertTrue(isinstance(price, CachedPrice))
+
+        for protocol in (0, pickle.HIGHEST_PROTOCOL):
+            copy = pickle.loads(pickle.dumps(price, protocol))
+            self.assertEqual(copy, price)
+            self.assertEqual(copy._instance, None)
+            self.assertEqual(copy.valid_from, price.valid_from)
+            self.assertAlmostEqual(copy.unit_tax, price.unit_tax)
+
+        instance = ProductPrice.objects.get(pk=price.pk)
+        self.assertEqual(price, instance)
+        self.assertEqual(unicode(price), unicode(instance))
+        for attr in ('unit_price', 'unit_price_incl_tax', 'unit_price_excl_tax',
+                'unit_tax'):
+            self.assertAlmostEqual(getattr(price, attr), getattr(instance, attr))
+
+        # The full instance is only loaded when it is needed
+        self.assertQueryCount(0, lambda: price.unit_price_excl_tax)
+        self.assertEqual(self.assertQueryCount(1, lambda: price.tax_class),
+            self.tax_class)
+        self.assertEqual(price.instance, instance)
+
+        item = order.modify_item(product.variations.get(), 2)
+        self.assertTrue(item.is_sale)
+        self.assertEqual(item.tax_class, self.tax_class)
+        self.assertAlmostEqual(item._unit_price, price.unit_price_excl_tax)
+
+        price = product.get_price(currency='EUR')
+        price.tax_class = self.tax_class_something
+        price.save()
+        self.assertEqual(product.get_price(currency='EUR').tax_rate,
+            self.tax_class_something.rate)
+
+    def test_33_price_cache_stampede(self):
+        """Test only one process recomputes flushed prices"""
+        from django.core.cache import cache
+        from options_product.caching import price_cache
+        from options_product.models import price_cache_keys
+
+        product = self.create_product()
+        prices = product.get_prices()
+
+        # Another process is busy recomputing the prices
+        product.flush_price_cache()
+        key = price_cache_keys([product.pk])[0][product.pk]
+        self.assertTrue(cache.add('%s:lock' % key, 1))
+        price_cache.reset_stats()
+
+        self.assertEqual(self.assertQueryCount(0, product.get_prices), prices)
+        self.assertEqual(price_cache.stats['stale_hits'], 1)
+
+        # Without stale value, waiting processes compute the prices
+        # themselves when the lock is not released in time
+        cache.delete(price_cache.stale_key(key))
+        lock_wait, price_cache.lock_wait = price_cache.lock_wait, 0.1
+        try:
+            self.assertEqual(self.assertQueryCount(1, product.get_prices), prices)
+        finally:
+            price_cache.lock_wait = lock_wait
+
+        # The lock of the other process is not released by the waiting one
+        self.assertEqual(cache.get('%s:lock' % key), 1)
+        self.assertEqual(cache.get(price_cache.stale_key(key))[1], prices)
+        self.assertEqual(self.assertQueryCount(0, product.get_prices), prices)
+
+        # Processes holding the lock release it
+        product.flush_price_cache()
+        key = price_cache_keys([product.pk])[0][product.pk]
+        self.assertEqual(self.assertQueryCount(1, product.get_prices), prices)
+        self.assertEqual(cache.get('%s:lock' % key), None)
+
+    def test_34_price_cache_generations(self):
+        """Test invalidating classes of cached prices"""
+        from options_product.caching import price_cache
+        from options_product.models import invalidate_price_cache
+
+        p1 = self.create_product()
+        p2 = self.create_product()
+        p2.prices.exclude(currency='CAD').delete()
+
+        def fetch():
+            return [p.get_prices() for p in Product.objects.all()]
+
+        prices = fetch()
+        self.assertQueryCount(1, fetch)
+
+        invalidate_price_cache()
+        self.assertEqual(self.assertQueryCount(3, fetch), prices)
+        self.assertQueryCount(1, fetch)
+
+        # Only products with EUR prices are affected
+        invalidate_price_cache(currency='EUR')
+        self.assertQueryCount(2, fetch)
+        invalidate_price_cache(currency='CAD')
+        self.assertQueryCount(3, fetch)
+
+        # Missing counters are initialized with a fresh value
+        price_cache.delete('product-prices-generation-all-%s' % '.'.join(
+            plata.settings.CURRENCIES))
+        self.assertQueryCount(3, fetch)
+        self.assertQueryCount(1, lambda: list(Product.objects.with_prices()))
+
+        p2.flush_price_cache()
+        self.assertQueryCount(2, fetch)
+
+        self.tax_class.rate = Decimal('8.00')
+        self.tax_class.save()
+        self.assertQueryCount(3, fetch)
+        self.assertEqual(Product.objects.get(pk=p1.pk).get_price(currency='CHF').tax_rate,
+            Decimal('8.00'))
+
+    def test_35_deferred_price_invalidation(self):
+        """Test coalescing price cache invalidations"""
+        from options_product.caching import deferred_invalidation, price_cache
+
+        p1 = self.create_product()
+        p2 = self.create_product()
+        p1.get_prices()
+        p2.get_prices()
+
+        deleted = []
+        written = []
+        delete_many = price_cache.shared.delete_many
+        price_cache.shared.delete_many = lambda keys: (deleted.append(keys),
+            delete_many(keys))
+
+        @deferred_invalidation()
+        def update_prices():
+            for product in (p1, p2, p1):
+                product.prices.filter(currency='EUR').update(_unit_price=Decimal('39.90'))
+                for price in product.prices.filter(currency='EUR'):
+                    price.save()
+                product.save()
+
+                with_deferred = deferred_invalidation()(lambda: product.save())
+                with_deferred()
+
+            self.assertEqual(deleted, [])
+            # The current thread sees its own changes, but does not store
+            # them in the cache before the invalidation has been sent
+            price_cache.shared.set = lambda *args: written.append(args)
+            price_cache.shared.set_many = lambda *args: written.append(args)
+            try:
+                self.assertAlmostEqual(Product.objects.get(pk=p1.pk).get_price(
+                    currency='EUR').unit_price, Decimal('39.90'))
+                Product.get_prices_bulk(Product.objects.all())
+            finally:
+                del price_cache.shared.set, price_cache.shared.set_many
+            self.assertEqual(written, [])
+
+        try:
+            update_prices()
+        finally:
+            price_cache.shared.delete_many = delete_many
+
+        self.assertEqual(len(deleted), 1)
+        self.assertEqual(sorted(deleted[0]), [
+            'product-prices-generation-product-%s' % p1.pk,
+            'product-prices-generation-product-%s' % p2.pk])
+        self.assertAlmostEqual(Product.objects.get(pk=p2.pk).get_price(
+            currency='EUR').unit_price, Decimal('39.90'))
+
+    def test_36_import_prices(self):
+        """Test importing prices in bulk"""
+        from options_product.price_import import PriceImportError, \
+            import_prices, read_csv, read_jsonl
+
+        p1 = self.create_product()
+        p2 = self.create_product()
+        p1.get_prices()
+        p2.get_prices()
+
+        csv = StringIO.StringIO('\n'.join([
+            'sku,currency,unit_price,tax_class,is_sale',
+            '%s,CHF,89.90,Standard Swiss Tax Rate,0' % p1.sku,
+            '%s,CHF,59.90,%s,1' % (p1.sku, self.tax_class.pk),
+            'unknown,CHF,10.00,%s,0' % self.tax_class.pk,
+            '%s,CHF,69.90,%s,0' % (p2.sku, self.tax_class.pk),
+            ]))
+
+        result = import_prices(read_csv(csv), batch_size=2)
+        self.assertEqual(result, {'imported': 3, 'unknown_skus': set(['unknown'])})
+
+        p1 = Product.objects.get(pk=p1.pk)
+        self.assertAlmostEqual(p1.get_price(currency='CHF').unit_price, Decimal('59.90'))
+        self.assertAlmostEqual(dict(p1.get_prices())['CHF']['normal'].unit_price,
+            Decimal('89.90'))
+
+        p2 = Product.objects.get(pk=p2.pk)
+        self.assertAlmostEqual(dict(p2.get_prices())['CHF']['normal'].unit_price,
+            Decimal('69.90'))
+
+        # Prices starting the same day are deactivated, older prices end
+        # the day before, and prices starting later are left alone
+        yesterday = date.today() - timedelta(days=1)
+        self.assertEqual(sorted((p.unit_price, p.is_active, p.valid_until)
+                for p in p2.prices.filter(currency='CHF', is_sale=False)), [
+            (Decimal('69.90'), True, None),
+            (Decimal('99.90'), False, None),
+            (Decimal('110.00'), False, None),
+            (Decimal('120.00'), True, None),
+            (Decimal('130.00'), True, date(2001, 1, 1)),
+            (Decimal('199.90'), True, date(2001, 1, 1)),
+            (Decimal('299.90'), True, yesterday),
+            ])
+
+        # Prices starting in the future end the current prices early
+        next_week = date.today() + timedelta(days=7)
+        jsonl = StringIO.StringIO('\n'.join([
+            '{"sku": "%s", "currency": "EUR", "unit_price": "44.90", "tax_class": %s,'
+            ' "valid_from": "%s"}' % (p2.sku, self.tax_class_germany.pk, next_week),
+            '',
+            ]))
+
+        self.assertEqual(self.assertQueryCount(7, lambda: import_prices(read_jsonl(jsonl))),
+            {'imported': 1, 'unknown_skus': set()})
+        self.assertEqual(sorted((p.unit_price, p.valid_from, p.valid_until)
+                for p in p2.prices.filter(currency='EUR')), [
+            (Decimal('44.90'), next_week, None),
+            (Decimal('49.90'), date.today(), next_week - timedelta(days=1)),
+            ])
+        self.assertAlmostEqual(Product.objects.get(pk=p2.pk).get_price(
+            currency='EUR').unit_price, Decimal('49.90'))
+
+        self.assertRaises(PriceImportError, lambda: import_prices([
+            {'sku': p1.sku, 'currency': 'CHF', 'unit_price': 'abc', 'tax_class': 'x'}]))
+        self.assertRaises(PriceImportError, lambda: import_prices([
+            {'sku': p1.sku, 'currency': 'XYZ', 'unit_price': '1', 'tax_class': 'x'}]))
+        self.assertRaises(PriceImportError, lambda: list(read_csv(StringIO.StringIO(
+            'sku,currency\n%s,CHF,surplus\n' % p1.sku))))
+
+        # Imported prices supersede each other independent of their order
+        # and of the batches they are processed in
+        in_two_weeks = date.today() + timedelta(days=14)
+        rows = [
+            {'sku': p1.sku, 'currency': 'CAD', 'unit_price': '1', 'valid_from': next_week,
+                'tax_class': self.tax_class.pk},
+            {'sku': p1.sku, 'currency': 'CAD', 'unit_price': '2', 'valid_from': in_two_weeks,
+                'tax_class': self.tax_class.pk},
+            {'sku': p1.sku, 'currency': 'CAD', 'unit_price': '3', 'valid_from': next_week,
+                'tax_class': self.tax_class.pk},
+            ]
+        for batch_size, order in ((1, rows), (1, rows[::-1]), (3, rows[::-1])):
+            p1.prices.filter(currency='CAD').exclude(_unit_price=Decimal('65.00')).delete()
+            import_prices([dict(row) for row in order], batch_size=batch_size)
+            self.assertEqual(sorted((p._unit_price, p.valid_until) for p in
+                    p1.prices.filter(currency='CAD', is_active=True)), sorted([
+                (Decimal('2.00'), None),
+                (Decimal(order[-1]['unit_price']), in_two_weeks - timedelta(days=1)),
+                (Decimal('65.00'), next_week - timedelta(days=1)),
+                ]))
+
+    def test_37_quantity_tiers(self):
+        """Test resolving quantity tiered prices"""
+        p1 = self.create_product()
+        p1.prices.create(currency='CHF', tax_class=self.tax_class,
+            _unit_price=Decimal('69.90'), min_quantity=10)
+        p1.prices.create(currency='CHF', tax_class=self.tax_class,
+            _unit_price=Decimal('89.90'), min_quantity=20)
+        p1.prices.create(currency='CHF', tax_class=self.tax_class,
+            _unit_price=Decimal('59.90'), min_quantity=50)
+        p1.prices.create(currency='CHF', tax_class=self.tax_class,
+            _unit_price=Decimal('49.90'), min_quantity=100, is_active=False)
+        p1.prices.create(currency='EUR', tax_class=self.tax_class_germany,
+            _unit_price=Decimal('39.90'), min_quantity=10)
+
+        p1 = Product.objects.get(pk=p1.pk)
+        p1.get_prices()
+
+        def prices():
+            return [p1.get_price(currency='CHF', quantity=quantity).unit_price
+                for quantity in (None, 1, 9, 10, 19, 20, 49, 50, 100)]
+
+        # Tiers are only used if they are cheaper than the sale price, and
+        # higher tiers never cost more than lower ones
+        self.assertEqual(self.assertQueryCount(0, prices), [Decimal('79.90')] * 3
+            + [Decimal('69.90')] * 4 + [Decimal('59.90')] * 2)
+        self.assertEqual(dict(p1.get_prices())['CHF']['tiers'][0], (10, 20, 50))
+        self.assertAlmostEqual(p1.get_price(currency='EUR', quantity=10).unit_price,
+            Decimal('39.90'))
+        self.assertEqual(dict(p1.get_prices())['CAD'].get('tiers'), None)
+
+        order = self.create_order()
+        variation = p1.variations.get()
+        order.modify_item(variation, 10)
+        self.assertAlmostEqual(order.items.get().unit_price, Decimal('69.90'))
+        order.modify_item(variation, 40)
+        self.assertAlmostEqual(order.items.get().unit_price, Decimal('59.90'))
+
+        # Tiered sale prices do not put the product in sale
+        p1.prices.filter(is_sale=True).delete()
+        p1.prices.create(currency='CHF', tax_class=self.tax_class,
+            _unit_price=Decimal('29.90'), min_quantity=10, is_sale=True)
+        p1 = Product.objects.get(pk=p1.pk)
+        self.assertFalse(p1.in_sale('CHF'))
+        self.assertEqual(list(Product.objects.in_sale('CHF')), [])
+        self.assertAlmostEqual(p1.get_price(currency='CHF', quantity=5).unit_price,
+            Decimal('99.90'))
+        self.assertAlmostEqual(p1.get_price(currency='CHF', quantity=10).unit_price,
+            Decimal('29.90'))
+
+    def test_38_create_variations(self):
+        """Test creating variations in bulk"""
+        size = OptionGroup.objects.create(name='size')
+        for idx, name in enumerate(('S', 'M', 'L')):
+            size.options.create(name=name, value=name.lower(), ordering=idx)
+        color = OptionGroup.objects.create(name='color')
+        red = color.options.create(name='red', value='red', ordering=0)
+        color.options.create(name='blue', value='blue', ordering=2)
+
+        product = Product.objects.create(name='Shirt', slug='shirt')
+        product.option_groups = [size, color]
+
+        self.assertQueryCount(6, product.create_variations)
+        self.assertEqual([(v.sku, v.ordering, v.options_name_cache,
+                sorted(v.options.values_list('name', flat=True)))
+                for v in product.variations.all()], [
+            (u'shirt-s-red', 0, u'S, red', [u'S', u'red']),
+            (u'shirt-s-blue', 1, u'S, blue', [u'S', u'blue']),
+            (u'shirt-m-red', 2, u'M, red', [u'M', u'red']),
+            (u'shirt-m-blue', 3, u'M, blue', [u'M', u'blue']),
+            (u'shirt-l-red', 4, u'L, red', [u'L', u'red']),
+            (u'shirt-l-blue', 5, u'L, blue', [u'L', u'blue']),
+            ])
+
+        # Nothing to do
+        self.assertQueryCount(3, product.create_variations)
+
+        # New options are inserted in between
+        color.options.create(name='green', value='green', ordering=1)
+        self.assertQueryCount(7, product.create_variations)
+        self.assertEqual([v.sku for v in product.variations.all()], [
+            u'shirt-s-red', u'shirt-s-green', u'shirt-s-blue',
+            u'shirt-m-red', u'shirt-m-green', u'shirt-m-blue',
+            u'shirt-l-red', u'shirt-l-green', u'shirt-l-blue',
+            ])
+
+        # Variations are still found after removing an option group
+        product.option_groups = [color]
+        self.assertQueryCount(3, product.create_variations)
+        self.assertEqual(product.variations.count(), 9)
+        self.assertEqual(product.variations.get(ordering=0).sku, u'shirt-s-red')
+
+        # Combinations whose option values are the same are all created
+        tshirt = Product.objects.create(name='T-Shirt', slug='tshirt')
+        tshirt.option_groups = [color]
+        navy = color.options.create(name='navy', value='blue', ordering=3)
+        self.assertEqual(tshirt.create_variations(), 4)
+        self.assertEqual([(v.sku, list(v.options.all())) for v in tshirt.variations.all()], [
+            (u'tshirt-red', [red]),
+            (u'tshirt-green', [color.options.get(name='green')]),
+            (u'tshirt-blue-2', [color.options.get(name='blue')]),
+            (u'tshirt-blue-3', [navy]),
+            ])
+
+    def test_39_options_signature(self):
+        """Test variations are identified by their options signature"""
+        from django.db import IntegrityError
+        from options_product.views import ProductView
+
+        size = OptionGroup.objects.create(name='size')
+        s = size.options.create(name='S', value='s', ordering=0)
+        m = size.options.create(name='M', value='m', ordering=1)
+        color = OptionGroup.objects.create(name='color')
+        red = color.options.create(name='red', value='red')
+
+        product = Product.objects.create(name='Shirt', slug='shirt')
+        product.option_groups = [color, size]
+        product.create_variations()
+
+        self.assertEqual(sorted(product.variations.values_list(
+            'sku', 'options_signature')), [
+            (u'shirt-m-red', u'%s_%s' % (m.pk, red.pk)),
+            (u'shirt-s-red', u'%s_%s' % (s.pk, red.pk)),
+            ])
+        self.assertEqual(product.items_in_stock(), {
+            '%s_%s' % (s.pk, red.pk): 0,
+            '%s_%s' % (m.pk, red.pk): 0,
+            })
+
+        # Signatures follow changes from both sides of the relation
+        variation = product.variations.get(sku='shirt-s-red')
+        variation.options.remove(red)
+        self.assertEqual(variation.options_signature, unicode(s.pk))
+        red.variations.add(variation)
+        self.assertEqual(ProductVariation.objects.get(pk=variation.pk).options_signature,
+            u'%s_%s' % (s.pk, red.pk))
+        red.variations.clear()
+        self.assertEqual(sorted(product.variations.values_list('options_signature',
+            flat=True)), [unicode(s.pk), unicode(m.pk)])
+        variation.options.clear()
+        self.assertEqual(ProductVariation.objects.get(pk=variation.pk).options_signature,
+            None)
+
+        variation.options = [s, red]
+        duplicate = product.variations.create(sku='duplicate')
+        self.assertRaises(IntegrityError, lambda: duplicate.options.add(s, red))
+        duplicate.delete()
+
+        # Cart form lookups use the signature
+        self.create_tax_classes()
+        product.prices.create(currency='CHF', tax_class=self.tax_class,
+            _unit_price=Decimal('19.90'))
+        Form = ProductView().order_modify_item_form(None, product)
+        form = Form({'quantity': 0, 'option_%s' % size.pk: s.pk,
+            'option_%s' % color.pk: red.pk}, order=self.create_order())
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['variation'], variation)
+
+    def test_40_sparse_variations(self):
+        """Test variations of sparse products are created on demand"""
+        from django.db import IntegrityError
+        from options_product.views import ProductView
+
+        size = OptionGroup.objects.create(name='size')
+        s = size.options.create(name='S', value='s', ordering=0)
+        m = size.options.create(name='M', value='m', ordering=1)
+        color = OptionGroup.objects.create(name='color')
+        red = color.options.create(name='red', value='red', ordering=0)
+        blue = color.options.create(name='blue', value='blue', ordering=1)
+
+        product = Product.objects.create(name='Shirt', slug='shirt',
+            sparse_variations=True)
+        product.option_groups = [size, color]
+        product.create_variations()
+        self.assertEqual(product.variations.count(), 0)
+
+        space = product.combination_space()
+        self.assertEqual(space.describe(), [
+            {'id': size.pk, 'options': [s.pk, m.pk]},
+            {'id': color.pk, 'options': [red.pk, blue.pk]},
+            ])
+        self.assertEqual(len(list(space)), 4)
+        self.assertTrue(space.is_valid([red, m]))
+        self.assertFalse(space.is_valid([s, m]))
+        self.assertFalse(space.is_valid([s]))
+
+        variation = product.variation_for_options([m, blue])
+        self.assertEqual((variation.sku, variation.options_name_cache),
+            (u'shirt-m-blue', u'M, blue'))
+        self.assertEqual(self.assertQueryCount(1,
+            lambda: product.variation_for_options([blue, m])), variation)
+        self.assertRaises(ProductVariation.DoesNotExist,
+            lambda: product.variation_for_options([m, s]))
+        self.assertRaises(ProductVariation.DoesNotExist,
+            lambda: product.variation_for_options([m, red], create=False))
+        self.assertEqual(product.variations.count(), 1)
+
+        # The cart form offers all options and creates variations
+        self.create_tax_classes()
+        product.prices.create(currency='CHF', tax_class=self.tax_class,
+            _unit_price=Decimal('19.90'))
+        Form = ProductView().order_modify_item_form(None, product)
+        form = Form({'quantity': 0, 'option_%s' % size.pk: s.pk,
+            'option_%s' % color.pk: red.pk}, order=self.create_order())
+        self.assertEqual(len(form.fields['option_%s' % color.pk].choices), 3)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['variation'].sku, u'shirt-s-red')
+        self.assertEqual(product.variations.count(), 2)
+
+        # SKUs taken by other combinations are disambiguated
+        navy = color.options.create(name='navy', value='blue', ordering=2)
+        variation = product.variation_for_options([m, navy])
+        self.assertEqual((variation.sku, variation.ordering), (u'shirt-m-blue-5', 5))
+        self.assertEqual(product.variation_for_options([navy, m]), variation)
+        variation.delete()
+        navy.delete()
+
+        # Without a free SKU, the IntegrityError is raised
+        other = Product.objects.create(name='Other', slug='other')
+        other.variations.create(sku='shirt-s-blue')
+        other.variations.create(sku='shirt-s-blue-1')
+        self.assertRaises(IntegrityError, lambda: product.variation_for_options([s, blue]))
+        other.delete()
+
+        # Dense products do not create variations on demand
+        product.sparse_variations = False
+        product.save()
+        self.assertRaises(ProductVariation.DoesNotExist,
+            lambda: product.variation_for_options([m, red]))
+        product.create_variations()
+        self.assertEqual(product.variations.count(), 4)
+
+    def test_41_combination_space(self):
+        """Test indexing and chunking combinations of options"""
+        from itertools import product as itertools_product
+        from options_product.combinations import CombinationSpace
+
+        groups = []
+        for name, values in (('size', 'sml'), ('color', 'rgb'), ('fit', 'ab')):
+            group = OptionGroup.objects.create(name=name)
+            groups.append(group)
+            for idx, value in enumerate(values):
+                group.options.create(name=value, value=value, ordering=idx)
+
+        product = Product.objects.create(name='Shirt', slug='shirt')
+        product.option_groups = groups
+        space = self.assertQueryCount(2, product.combination_space)
+
+        combinations = list(itertools_product(*[g.options.all() for g in groups]))
+        self.assertEqual(len(space), 18)
+        self.assertEqual(list(space), combinations)
+        for idx, combination in enumerate(combinations):
+            self.assertEqual(space.combination_at(idx), combination)
+            self.assertEqual(space.index_of(reversed(combination)), idx)
+            self.assertEqual(space.index_of([o.pk for o in combination]), idx)
+
+        self.assertEqual(list(space.iterate(5, 12)), combinations[5:12])
+        self.assertEqual(list(space.iterate(17)), combinations[17:])
+        self.assertEqual([(offset, len(chunk)) for offset, chunk in space.chunks(8, 3)],
+            [(3, 8), (11, 7)])
+        self.assertRaises(IndexError, lambda: space.combination_at(18))
+        self.assertRaises(ValueError, lambda: space.index_of(combinations[0][:2]))
+
+        self.assertEqual(len(CombinationSpace([])), 1)
+        self.assertEqual(list(CombinationSpace([])), [()])
+        self.assertEqual(len(CombinationSpace([(1, combinations[0]), (2, [])])), 0)
+        self.assertEqual(list(CombinationSpace([(2, [])])), [])
+
+        # Variations can be created in chunks
+        self.assertEqual(product.create_variations(10), 8)
+        self.assertEqual(product.create_variations(0, 10), 10)
+        self.assertEqual(product.create_variations(), 0)
+        self.assertEqual([v.options_name_cache for v in product.variations.all()],
+            [u', '.join(o.name for o in c) for c in combinations])
+        self.assertEqual(list(product.variations.values_list('ordering', flat=True)),
+            range(18))
+
+        # Sparse variations are ordered by their position too
+        product.variations.all().delete()
+        product.sparse_variations = True
+        variation = product.variation_for_options(reversed(combinations[13]))
+        self.assertEqual((variation.ordering, variation.sku), (13, u'shirt-l-r-b'))
+
+        # Positions in large spaces are stored as they are
+        groups = []
+        for name in 'abcdef':
+            group = OptionGroup.objects.create(name=name)
+            groups.append(group)
+            for idx in range(40):
+                group.options.create(name='%s%s' % (name, idx), value=idx, ordering=idx)
+        product = Product.objects.create(name='Large', slug='large',
+            sparse_variations=True)
+        product.option_groups = groups
+        space = product.combination_space()
+        self.assertEqual(len(space), 40 ** 6)
+        product.variation_for_options(space.combination_at(len(space) - 1))
+        self.assertEqual(product.variations.get().ordering, 40 ** 6 - 1)
+
+    def test_42_variation_sync_jobs(self):
+        """Test creating variations for new options in resumable jobs"""
+        from django.core.management import call_command
+        from options_product.models import VariationSyncJob
+
+        size = OptionGroup.objects.create(name='size')
+        s = size.options.create(name='S', value='s', ordering=0)
+        size.options.create(name='M', value='m', ordering=1)
+        color = OptionGroup.objects.create(name='color')
+        red = color.options.create(name='red', value='red', ordering=0)
+
+        products = []
+        for idx in range(4):
+            product = Product.objects.create(name='Shirt', slug='shirt%s' % idx,
+                sparse_variations=(idx == 3))
+            product.option_groups = [size, color]
+            product.create_variations()
+            products.append(product)
+
+        # One job per option and one per product
+        self.assertEqual(VariationSyncJob.objects.pending().count(), 7)
+        VariationSyncJob.objects.all().delete()
+
+        blue = color.options.create(name='blue', value='blue', ordering=1)
+        job = VariationSyncJob.objects.get()
+        self.assertEqual(job.option, blue)
+
+        self.assertFalse(job.process(batch_size=2))
+        self.assertEqual((job.status, job.progress(), job.variations_created),
+            (VariationSyncJob.RUNNING, u'2/3', 4))
+        job = VariationSyncJob.objects.get()
+        self.assertTrue(job.process(batch_size=2))
+        self.assertEqual((job.status, job.progress(), job.variations_created),
+            (VariationSyncJob.DONE, u'3/3', 6))
+
+        self.assertEqual([v.sku for v in products[2].variations.all()], [
+            u'shirt2-s-red', u'shirt2-s-blue', u'shirt2-m-red', u'shirt2-m-blue'])
+        self.assertEqual(products[3].variations.count(), 0)
+
+        # Deleting an option retires its variations
+        blue.delete()
+        self.assertEqual(VariationSyncJob.objects.count(), 0)
+        self.assertEqual(list(products[0].variations.filter(is_active=True).values_list(
+            'sku', 'options_signature')), [
+            (u'shirt0-s-red', u'%s_%s' % (s.pk, red.pk)),
+            (u'shirt0-m-red', u'%s_%s' % (s.pk + 1, red.pk)),
+            ])
+        self.assertEqual(list(products[0].variations.filter(is_active=False).values_list(
+            'sku', 'options_signature')), [
+            (u'shirt0-s-blue', None),
+            (u'shirt0-m-blue', None),
+            ])
+
+        # Retired variations are not mistaken for variations without options
+        cap = Product.objects.create(name='Cap', slug='cap')
+        cap.create_variations()
+        white = color.options.create(name='white', value='white', ordering=3)
+        cap.variations.create(sku='cap-white', ordering=1).options.add(white)
+        white.delete()
+        self.assertEqual(cap.variations.filter(options_signature=None).count(), 2)
+        self.assertEqual(cap.variation_for_options([]).sku, u'cap')
+
+        # Changing the option groups of a product creates one job
+        products[0].option_groups = [size]
+        self.assertEqual(VariationSyncJob.objects.pending().count(), 1)
+
+        color.options.create(name='green', value='green', ordering=2)
+        call_command('sync_variations', verbosity=0)
+        self.assertEqual(VariationSyncJob.objects.pending().count(), 0)
+        self.assertEqual(sorted(VariationSyncJob.objects.values_list(
+            'products_total', 'variations_created')), [(1, 0), (2, 4)])
+
+        # Removing an option group from all its products creates one job
+        # per product
+        VariationSyncJob.objects.all().delete()
+        color.products.remove()
+        self.assertEqual(VariationSyncJob.objects.count(), 0)
+        color.products.clear()
+        self.assertEqual(sorted(VariationSyncJob.objects.pending().values_list(
+            'product', flat=True)), [p.pk for p in products[1:]])
+
+    def test_43_options_name_cache(self):
+        """Test variation names are regenerated after renaming options"""
+        size = OptionGroup.objects.create(name='size')
+        s = size.options.create(name='S', value='s', ordering=0)
+        size.options.create(name='M', value='m', ordering=1)
+        color = OptionGroup.objects.create(name='color')
+        red = color.options.create(name='red', value='red', ordering=0)
+        color.options.create(name='blue', value='blue', ordering=1)
+
+        for idx in range(3):
+            product = Product.objects.create(name='Shirt', slug='shirt%s' % idx)
+            product.option_groups = [size, color]
+            product.create_variations()
+
+        red.name = 'crimson'
+        self.assertQueryCount(5, red.save)
+        self.assertEqual(sorted(set(ProductVariation.objects.values_list(
+            'options_name_cache', flat=True))), [
+            u'M, blue', u'M, crimson', u'S, blue', u'S, crimson'])
+
+        variation = ProductVariation.objects.filter(options=s).filter(options=red)[0]
+        variation._regenerate_cache()
+        self.assertEqual(variation.options_name_cache, u'S, crimson')
+
+    def test_44_stock_matrix(self):
+        """Test the stock matrix is cached until the stock changes"""
+        size = OptionGroup.objects.create(name='size')
+        s = size.options.create(name='S', value='s', ordering=0)
+        m = size.options.create(name='M', value='m', ordering=1)
+        color = OptionGroup.objects.create(name='color')
+        red = color.options.create(name='red', value='red')
+
+        product = Product.objects.create(name='Shirt', slug='shirt')
+        product.option_groups = [size, color]
+        product.create_variations()
+
+        s_red = '%s_%s' % (s.pk, red.pk)
+        m_red = '%s_%s' % (m.pk, red.pk)
+
+        self.assertEqual(self.assertQueryCount(1, product.stock_matrix), {
+            s_red: 0, m_red: 0})
+        self.assertQueryCount(0, product.stock_matrix)
+        self.assertEqual(simplejson.loads(product.stock_matrix_json()), {
+            s_red: 0, m_red: 0})
+
+        # Stock transactions update the stock without sending signals
+        variation = product.variations.get(sku='shirt-s-red')
+        variation.stock_transactions.create(type=StockTransaction.PURCHASE, change=10)
+        self.assertEqual(product.stock_matrix(), {s_red: 10, m_red: 0})
+
+        variation = product.variations.get(sku='shirt-m-red')
+        variation.is_active = False
+        variation.save()
+        self.assertEqual(product.stock_matrix(), {s_red: 10})
+
+        # Changing the options changes the keys
+        variation = product.variations.get(sku='shirt-s-red')
+        variation.options.remove(red)
+        self.assertEqual(product.stock_matrix(), {str(s.pk): 10})
+        red.variations.add(variation)
+        self.assertEqual(product.stock_matrix(), {s_red: 10})
+
+    def test_45_option_availability(self):
+        """Test the option availability index"""
+        from options_product.availability import AvailabilityIndex
+
+        size = OptionGroup.objects.create(name='size')
+        s = size.options.create(name='S', value='s', ordering=0)
+        m = size.options.create(name='M', value='m', ordering=1)
+        color = OptionGroup.objects.create(name='color')
+        red = color.options.create(name='red', value='red', ordering=0)
+        blue = color.options.create(name='blue', value='blue', ordering=1)
+
+        product = Product.objects.create(name='Shirt', slug='shirt')
+        product.option_groups = [size, color]
+        product.create_variations()
+
+        product.variations.filter(sku='shirt-m-blue').update(is_active=False)
+        product.variations.get(sku='shirt-s-blue').stock_transactions.create(
+            type=StockTransaction.PURCHASE, change=5)
+
+        availability = self.assertQueryCount(1, product.option_availability)
+        self.assertEqual(len(availability.variations), 3)
+        self.assertEqual(availability.available_options(),
+            set([s.pk, m.pk, red.pk, blue.pk]))
+        self.assertEqual(availability.available_options([m]),
+            set([s.pk, m.pk, red.pk]))
+        self.assertEqual(availability.available_options([blue.pk]),
+            set([s.pk, red.pk, blue.pk]))
+        self.assertEqual(availability.available_options(in_stock=True),
+            set([s.pk, blue.pk]))
+        self.assertEqual(availability.variations_for([s, blue]), [
+            product.variations.get(sku='shirt-s-blue').pk])
+        self.assertEqual(availability.variations_for([m, blue]), [])
+
+        description = simplejson.loads(simplejson.dumps(availability.describe()))
+        self.assertEqual(AvailabilityIndex.from_description(
+            description).available_options([m]), set([s.pk, m.pk, red.pk]))
+
+        # Cached until the variations or their stock change
+        self.assertQueryCount(0, product.option_availability)
+        variation = product.variations.get(sku='shirt-m-blue')
+        variation.is_active = True
+        variation.save()
+        self.assertEqual(product.option_availability().available_options([m]),
+            set([s.pk, m.pk, red.pk, blue.pk]))
+
+        variation.stock_transactions.create(type=StockTransaction.PURCHASE, change=1)
+        self.assertEqual(product.option_availability().available_options(
+            [m], in_stock=True), set([s.pk, m.pk, blue.pk]))
+
+    def test_46_order_item_form_schema(self):
+        """Test cart forms are built from a cached option schema"""
+        from options_product.views import ProductView
+
+        self.create_tax_classes()
+        order = self.create_order()
+        view = ProductView()
+
+        def create_product(slug, group_count):
+            groups = []
+            for idx in range(group_count):
+                group = OptionGroup.objects.create(name='group%s' % idx)
+                group.options.create(name='A', value='a', ordering=0)
+                group.options.create(name='B', value='b', ordering=1)
+                groups.append(group)
+
+            product = Product.objects.create(name=slug, slug=slug)
+            product.option_groups = groups
+            product.create_variations()
+            product.prices.create(currency='CHF', tax_class=self.tax_class,
+                _unit_price=Decimal('19.90'))
+
+            data = {'quantity': 0}
+            for group in groups:
+                data['option_%s' % group.pk] = group.options.all()[1].pk
+            return product, data
+
+        def post(product, data):
+            Form = view.order_modify_item_form(None, product)
+            form = Form(data, order=order, product=product)
+            self.assertTrue(form.is_valid())
+            return form
+
+        # GET and POST take the same number of queries, however many option
+        # groups there are
+        for slug, group_count in (('one', 1), ('three', 3)):
+            product, data = create_product(slug, group_count)
+            post(product, data)
+            product = Product.objects.get(pk=product.pk)
+
+            Form = self.assertQueryCount(0,
+                lambda: view.order_modify_item_form(None, product))
+            self.assertEqual(len(self.assertQueryCount(0,
+                lambda: Form(product=product)).fields), group_count + 1)
+            self.assertQueryCount(2, post, product, data)
+
+        # The form class is reused until the options change
+        Form = view.order_modify_item_form(None, product)
+        self.assertTrue(view.order_modify_item_form(None, product) is Form)
+        option = product.option_groups.all()[0].options.all()[0]
+        option.name = 'C'
+        option.save()
+        Form = view.order_modify_item_form(None, product)
+        self.assertEqual(Form(product=product).fields[
+            'option_%s' % option.group_id].choices[1], (option.pk, u'C'))
+
+    def test_47_product_for_detail(self):
+        """Test loading product detail data with a constant number of queries"""
+        from options_product.producer.models import Producer
+
+        self.create_tax_classes()
+        producer = Producer.objects.create(name='Producer', slug='producer')
+        category = Category.objects.create(name='Category', slug='category')
+
+        for slug, group_count in (('one', 1), ('three', 3)):
+            groups = []
+            for idx in range(group_count):
+                group = OptionGroup.objects.create(name='%s%s' % (slug, idx))
+                for value in 'abc':
+                    group.options.create(name=value.upper(), value=value)
+                groups.append(group)
+
+            product = Product.objects.create(name=slug, slug=slug, producer=producer)
+            product.option_groups = groups
+            product.categories = [category]
+            product.create_variations()
+            product.prices.create(currency='CHF', tax_class=self.tax_class,
+                _unit_price=Decimal('19.90'))
+            product.flush_price_cache()
+
+            product = self.assertQueryCount(8, Product.objects.for_detail, product.pk)
+
+            def use():
+                self.assertEqual(len(product.detail_option_groups), group_count)
+                self.assertEqual([len(group.detail_options)
+                    for group in product.detail_option_groups], [3] * group_count)
+                self.assertEqual(len(product.detail_variations), 3 ** group_count)
+                for variation in product.detail_variations:
+                    self.assertEqual(len(variation.detail_options), group_count)
+                    self.assertEqual(variation.get_price(currency='CHF').unit_price,
+                        Decimal('19.90'))
+                self.assertEqual(product.main_image, None)
+                self.assertEqual(product.detail_categories, [category])
+                self.assertEqual(product.producer, producer)
+
+            self.assertQueryCount(0, use)
+
+        variation = product.detail_variations[-1]
+        self.assertEqual(variation.detail_options, list(variation.options.all()))
+        self.assertRaises(Product.DoesNotExist,
+            lambda: Product.objects.active().for_detail(0))
+
+    def test_48_stock_reservations(self):
+        """Test reserving stock for carts against the variation counters"""
+        from options_product.models import StockReservation
+        from options_product.views import ProductView
+
+        self.create_tax_classes()
+        product = Product.objects.create(name='Shirt', slug='shirt')
+        product.create_variations()
+        product.prices.create(currency='CHF', tax_class=self.tax_class,
+            _unit_price=Decimal('19.90'))
+        variation = product.variations.get()
+        variation.stock_transactions.create(type=StockTransaction.PURCHASE, change=5)
+
+        def counters():
+            return ProductVariation.objects.filter(pk=variation.pk).values_list(
+                'items_in_stock', 'items_reserved')[0]
+
+        order1 = self.create_order()
+        order2 = Order.objects.create(currency='CHF')
+
+        self.assertEqual(product.stock_matrix(), {'': 5})
+        self.assertEqual(product.option_availability().in_stock, 1)
+
+        self.assertTrue(StockReservation.objects.reserve(variation, order1, 3))
+        self.assertFalse(StockReservation.objects.reserve(variation, order2, 3))
+        self.assertEqual(StockReservation.objects.available(variation, order2), 2)
+        self.assertEqual(StockReservation.objects.available(variation, order1), 5)
+        self.assertTrue(StockReservation.objects.reserve(variation, order2, 2))
+        self.assertEqual(counters(), (5, 5))
+
+        # Cached stock data only contains items which are not reserved
+        self.assertEqual(product.stock_matrix(), {'': 0})
+        self.assertEqual(product.option_availability().in_stock, 0)
+
+        # Changing a reservation only applies the difference
+        self.assertTrue(StockReservation.objects.reserve(variation, order1, 1))
+        self.assertEqual(counters(), (5, 3))
+        self.assertTrue(StockReservation.objects.reserve(variation, order2, 4))
+        self.assertEqual(counters(), (5, 5))
+        self.assertTrue(StockReservation.objects.reserve(variation, order2, 0))
+        self.assertEqual(counters(), (5, 1))
+        self.assertEqual(StockReservation.objects.count(), 1)
+
+        # The cart form reserves items, too
+        Form = ProductView().order_modify_item_form(None, product)
+        form = Form({'quantity': 5}, order=order2, product=product)
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors['quantity'],
+            [u'Only 4 items for %s available.' % variation])
+        form = Form({'quantity': 4}, order=order2, product=product)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(counters(), (5, 5))
+
+        # Reservations are returned if the item is not added after all
+        form.cancel_reservation()
+        self.assertEqual(counters(), (5, 1))
+        self.assertEqual(product.stock_matrix(), {'': 4})
+
+        # Nothing is reserved without a price
+        euro_form = Form({'quantity': 1}, order=Order.objects.create(currency='EUR'),
+            product=product)
+        self.assertFalse(euro_form.is_valid())
+        self.assertEqual(counters(), (5, 1))
+
+        form.full_clean()
+        self.assertEqual(counters(), (5, 5))
+        order2.modify_item(variation, relative=4)
+        self.assertEqual(counters(), (5, 5))
+
+        # Stock transactions of the order replace the reservation
+        variation.stock_transactions.create(type=StockTransaction.SALE,
+            change=-4, order=order2)
+        self.assertEqual(counters(), (1, 1))
+
+        # Deleting order items and orders releases their reservations
+        self.assertTrue(StockReservation.objects.reserve(variation, order2, 0))
+        order1.modify_item(variation, absolute=1)
+        order1.modify_item(variation, absolute=0)
+        self.assertEqual(counters(), (1, 0))
+        self.assertTrue(StockReservation.objects.reserve(variation, order1, 1))
+        order1.delete()
+        self.assertEqual(counters(), (1, 0))
+
+        # Expired reservations are released in bulk
+        self.assertTrue(StockReservation.objects.reserve(variation, order2, 1))
+        self.assertEqual(StockReservation.objects.release(
+            StockReservation.objects.expired(datetime.now() + timedelta(days=1))), 1)
+        self.assertEqual(counters(), (1, 0))
+        self.assertEqual(StockReservation.objects.count(), 0)
+
+        # Expired payment process reservations do not block reservations
+        # although items_in_stock has not been recomputed yet
+        variation.stock_transactions.create(type=StockTransaction.PURCHASE, change=9)
+        payment = variation.stock_transactions.create(change=-7,
+            type=StockTransaction.PAYMENT_PROCESS_RESERVATION)
+        order3 = Order.objects.create(currency='CHF')
+        self.assertFalse(StockReservation.objects.reserve(variation, order3, 5))
+        self.assertEqual(StockReservation.objects.available(variation, order3), 3)
+
+        StockTransaction.objects.filter(pk=payment.pk).update(
+            created=datetime.now() - timedelta(minutes=20))
+        self.assertEqual(counters(), (3, 0))
+        self.assertTrue(StockReservation.objects.reserve(variation, order3, 5))
+        self.assertEqual(counters(), (10, 5))
+
+        # Stock transactions of the order itself are not counted against it
+        order4 = Order.objects.create(currency='CHF')
+        variation.stock_transactions.create(change=-4, order=order4,
+            type=StockTransaction.PAYMENT_PROCESS_RESERVATION)
+        self.assertEqual(StockReservation.objects.available(variation, order4), 5)
+        self.assertTrue(StockReservation.objects.reserve(variation, order4, 4))
+
+    def test_49_stock_snapshots(self):
+        """Test stock is computed from snapshots and newer transactions"""
+        from django.core.management import call_command
+        from options_product.caching import stock_cache
+        from options_product.snapshots.models import StockSnapshot
+
+        p1 = self.create_product()
+        p2 = self.create_product()
+        v1 = p1.variations.get()
+        v2 = p2.variations.get()
+
+        # The stock cache is invalidated after items_in_stock has been updated
+        seen = []
+        invalidate = stock_cache.invalidate
+        stock_cache.invalidate = lambda keys: (seen.append(
+            ProductVariation.objects.get(pk=v1.pk).items_in_stock), invalidate(keys))
+        try:
+            v1.stock_transactions.create(type=StockTransaction.PURCHASE, change=10)
+        finally:
+            del stock_cache.invalidate
+        self.assertEqual(seen, [10])
+
+        v1.stock_transactions.create(type=StockTransaction.SALE, change=-3)
+        v2.stock_transactions.create(type=StockTransaction.PURCHASE, change=5)
+        reservation = v2.stock_transactions.create(
+            type=StockTransaction.PAYMENT_PROCESS_RESERVATION, change=-1)
+
+        self.assertEqual(StockSnapshot.objects.create_snapshots(delay=0), 2)
+        self.assertEqual(sorted(StockSnapshot.objects.values_list(
+            'variation', 'items_in_stock')), [(v1.pk, 7), (v2.pk, 5)])
+
+        # Only transactions after the snapshot are summed
+        order = self.create_order()
+        v1.stock_transactions.create(type=StockTransaction.SALE, change=-2,
+            order=order)
+        self.assertEqual(ProductVariation.objects.get(pk=v1.pk).items_in_stock, 5)
+        self.assertEqual(StockSnapshot.objects.items_in_stock(v1,
+            exclude_order=order), 7)
+
+        # Payment process reservations are never part of snapshots
+        self.assertEqual(StockSnapshot.objects.items_in_stock(v2), 4)
+        StockTransaction.objects.filter(pk=reservation.pk).update(
+            created=datetime.now() - timedelta(hours=1))
+        self.assertEqual(StockSnapshot.objects.items_in_stock(v2), 5)
+
+        # Snapshots are advanced incrementally
+        v2.stock_transactions.create(type=StockTransaction.PURCHASE, change=2)
+        call_command('snapshot_stock', delay=0, batch_size=1, verbosity=0)
+        self.assertEqual(sorted(StockSnapshot.objects.values_list(
+            'variation', 'items_in_stock', 'last_transaction_id')), [
+            (v1.pk, 5, StockTransaction.objects.latest('id').pk),
+            (v2.pk, 7, StockTransaction.objects.latest('id').pk),
+            ])
+        self.assertEqual(StockSnapshot.objects.items_in_stock(v2), 7)
+
+        # Changing or deleting transactions included in a snapshot discards it
+        sale = v1.stock_transactions.get(type=StockTransaction.SALE, order__isnull=True)
+        sale.change = -1
+        sale.save()
+        self.assertEqual(ProductVariation.objects.get(pk=v1.pk).items_in_stock, 7)
+        self.assertEqual(list(StockSnapshot.objects.values_list('variation', flat=True)),
+            [v2.pk])
+        call_command('snapshot_stock', delay=0, verbosity=0)
+        sale.delete()
+        self.assertEqual(ProductVariation.objects.get(pk=v1.pk).items_in_stock, 8)
+        self.assertEqual(StockSnapshot.objects.items_in_stock(v1), 8)
+
+    def test_50_order_lines(self):
+        """Test validating all order lines with a fixed number of queries"""
+        from django.core.exceptions import ValidationError
+        from options_product.checkout import order_lines, validate_order_lines
+        from options_product.models import StockReservation
+
+        order = self.create_order()
+
+        def check(count):
+            for idx in range(count):
+                product = self.create_product(stock=10)
+                order.modify_item(product.variations.get(), relative=2)
+                product.flush_price_cache()
+            return self.assertQueryCount(7, order_lines, order)
+
+        self.assertEqual(len(check(2)), 2)
+        lines = check(4)
+        self.assertEqual(len(lines), 6)
+        self.assertEqual([line['available'] for line in lines], [10] * 6)
+        self.assertEqual([line['price'].unit_price for line in lines],
+            [Decimal('79.90')] * 6)
+        validate_order_lines(order)
+
+        # Reservations of other orders reduce the availability
+        variation = lines[0]['variation']
+        StockReservation.objects.reserve(variation, order, 2)
+        StockReservation.objects.reserve(variation,
+            Order.objects.create(currency='CHF'), 7)
+        self.assertEqual(order_lines(order)[0]['available'], 3)
+
+        # Stock transactions of this order do not
+        variation.stock_transactions.create(order=order, change=-2,
+            type=StockTransaction.PAYMENT_PROCESS_RESERVATION)
+        self.assertEqual(order_lines(order)[0]['available'], 3)
+
+        # Expired payment process reservations do not, even before
+        # items_in_stock has been recomputed
+        payment = variation.stock_transactions.create(change=-3,
+            type=StockTransaction.PAYMENT_PROCESS_RESERVATION)
+        self.assertEqual(order_lines(order)[0]['available'], 0)
+        StockTransaction.objects.filter(pk=payment.pk).update(
+            created=datetime.now() - timedelta(minutes=20))
+        self.assertEqual(order_lines(order)[0]['available'], 3)
+
+        order.modify_item(variation, absolute=4)
+        self.assertRaisesWithCode(ValidationError,
+            lambda: validate_order_lines(order), code='insufficient_stock')
+
+        order.modify_item(variation, absolute=1)
+        variation.product.prices.all().delete()
+        self.assertRaisesWithCode(ValidationError,
+            lambda: validate_order_lines(order), code='price_missing')
+
+    def test_51_release_reservations(self):
+        """Test releasing expired reservations in bulk"""
+        from django.core.management import call_command
+        from options_product.models import StockReservation
+        from options_product.snapshots.models import StockSnapshot
+
+        p1 = self.create_product(stock=10)
+        v1 = p1.variations.get()
+        StockSnapshot.objects.create_snapshots(delay=0)
+        payment = v1.stock_transactions.create(change=-10,
+            type=StockTransaction.PAYMENT_PROCESS_RESERVATION)
+        self.assertEqual(ProductVariation.objects.get(pk=v1.pk).items_in_stock, 0)
+        self.assertEqual(p1.option_availability().in_stock, 0)
+
+        p2 = self.create_product(stock=5)
+        v2 = p2.variations.get()
+        order1 = self.create_order()
+        order2 = Order.objects.create(currency='CHF')
+        self.assertTrue(StockReservation.objects.reserve(v2, order1, 3))
+        self.assertTrue(StockReservation.objects.reserve(v2, order2, 2))
+
+        # Nothing has expired yet
+        call_command('release_reservations', verbosity=0)
+        self.assertEqual(StockReservation.objects.count(), 2)
+        self.assertEqual(StockTransaction.objects.count(), 3)
+
+        StockReservation.objects.filter(order=order1).update(
+            expires=datetime.now() - timedelta(minutes=1))
+        StockTransaction.objects.filter(pk=payment.pk).update(
+            created=datetime.now() - timedelta(hours=1))
+        self.assertEqual(ProductVariation.objects.get(pk=v1.pk).items_in_stock, 0)
+
+        call_command('release_reservations', batch_size=1, verbosity=0)
+        self.assertEqual(list(StockReservation.objects.values_list(
+            'order', 'quantity')), [(order2.pk, 2)])
+        self.assertEqual(ProductVariation.objects.filter(pk=v2.pk).values_list(
+            'items_in_stock', 'items_reserved')[0], (5, 2))
+        self.assertFalse(StockTransaction.objects.filter(pk=payment.pk).exists())
+        self.assertEqual(ProductVariation.objects.get(pk=v1.pk).items_in_stock, 10)
+
+        # Cached availability has been invalidated
+        self.assertEqual(p1.option_availability().in_stock, 1)
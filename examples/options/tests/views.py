@@ -7,6 +7,8 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.core import mail
 from django.core.exceptions import ValidationError
+from django.core.urlresolvers import reverse
+from django.utils import simplejson
 
 import plata
 from plata.contact.models import Contact
@@ -757,3 +759,33 @@ class ViewTest(PlataTest):
         # 10 purchase, -5 sale, -1 sale
         self.assertEqual(StockTransaction.objects.count(), 3)
         self.assertEqual(p1.variations.get().items_in_stock, 4)
+
+    def test_15_option_availability(self):
+        """Test the option availability JSON endpoint"""
+        size = OptionGroup.objects.create(name='size')
+        s = size.options.create(name='S', value='s', ordering=0)
+        m = size.options.create(name='M', value='m', ordering=1)
+        color = OptionGroup.objects.create(name='color')
+        red = color.options.create(name='red', value='red', ordering=0)
+        blue = color.options.create(name='blue', value='blue', ordering=1)
+
+        p1 = self.create_product()
+        p1.option_groups = [size, color]
+        p1.create_variations()
+        p1.variations.filter(options=m).filter(options=blue).update(is_active=False)
+        p1.variations.filter(options=s).filter(options=red).get(
+            ).stock_transactions.create(type=StockTransaction.PURCHASE, change=5)
+
+        url = reverse('plata_product_availability', kwargs={'object_id': p1.pk})
+        response = self.client.get(url, {'option': [m.pk]})
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+        # The variation without options created by create_product is active too
+        data = simplejson.loads(response.content)
+        self.assertEqual(len(data['variations']), 4)
+        self.assertEqual(data['available'], sorted([s.pk, m.pk, red.pk]))
+        self.assertEqual(data['available_in_stock'], [s.pk])
+        self.assertTrue(int(data['options'][str(red.pk)]['bits'], 16) & int(
+            data['in_stock'], 16))
+
+        self.assertEqual(self.client.get(url, {'option': 'x'}).status_code, 400)
@@ -19,6 +19,8 @@ urlpatterns = patterns('',
         name='plata_product_list'),
     url(r'^products/(?P<object_id>\d+)/$', 'options.views.product_detail',
         name='plata_product_detail'),
+    url(r'^products/(?P<object_id>\d+)/availability/$', 'options.views.product_availability',
+        name='plata_product_availability'),
 
     url(r'^reporting/', include('plata.reporting.urls')),
 
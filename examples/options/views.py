@@ -1,3 +1,4 @@
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.views.generic import  list_detail
 
@@ -15,14 +16,24 @@ shop = Shop(Contact, Order, Discount)
 
 def product_list(request):
     return list_detail.object_list(request,
-        queryset=Product.objects.active(),
+        queryset=Product.objects.active().with_prices(),
         paginate_by=9,
         template_name='product/product_list.html',
         )
 
 
 def product_detail(request, object_id):
-    product = get_object_or_404(Product.objects.active(), pk=object_id)
+    try:
+        product = Product.objects.active().for_detail(object_id)
+    except Product.DoesNotExist:
+        raise Http404
 
     view = ProductView()
     return view.product_detail(request, product)
+
+
+def product_availability(request, object_id):
+    product = get_object_or_404(Product.objects.active(), pk=object_id)
+
+    view = ProductView()
+    return view.option_availability(request, product)
@@ -35,7 +35,8 @@ class ProductVariationFormSet(BaseInlineFormSet):
         super(ProductVariationFormSet, self).clean()
 
         # This method ensures two things:
-        # 1. No combination of options occurs twice
+        # 1. No combination of options occurs twice (the database enforces
+        #    this too, but we want to show a validation error)
         # 2. SKUs are filled out and unique
         # 3. Active products have at least one active variation
         variations = set()
@@ -56,7 +57,7 @@ class ProductVariationFormSet(BaseInlineFormSet):
             options = form.cleaned_data.get('options')
 
             if options:
-                s = tuple(sorted(o.id for o in options))
+                s = models.options_signature(o.id for o in options)
 
                 if s in variations:
                     form._errors['options'] = form.error_class([
@@ -146,7 +147,7 @@ class ProductVariationInline(admin.TabularInline):
     form = ProductVariationForm
     formset = ProductVariationFormSet
     extra = 0
-    readonly_fields = ('items_in_stock',)
+    readonly_fields = ('items_in_stock', 'items_reserved')
 
 class OptionInline(admin.TabularInline):
     model = models.Option
@@ -202,7 +203,7 @@ if settings.OPTIONS_PRODUCT_FEINCMS:
             FEINCMS_CONTENT_FIELDSET,
             (_('Properties'), {
                 'fields': ('ordering', 'description', 'producer', 'categories',
-                    'option_groups', 'create_variations'),
+                    'option_groups', 'sparse_variations', 'create_variations'),
             }),
             ]
         inlines = [ProductVariationInline, ProductPriceInline, ProductImageInline]
@@ -221,18 +222,36 @@ class ReadonlyModelAdmin(admin.ModelAdmin):
 admin.site.register(models.ProductPrice,
     admin_class=ReadonlyModelAdmin,
     list_display=('__unicode__', 'product', 'currency', '_unit_price', 'tax_included',
-        'tax_class', 'is_active', 'valid_from', 'valid_until', 'is_sale'),
+        'tax_class', 'is_active', 'valid_from', 'valid_until', 'is_sale', 'min_quantity'),
     list_filter=('is_active', 'is_sale', 'tax_included', 'tax_class', 'currency'),
     readonly_fields=('product', 'currency', '_unit_price', 'tax_included', 'tax_class',
-        'is_active', 'valid_from', 'valid_until', 'is_sale'),
+        'is_active', 'valid_from', 'valid_until', 'is_sale', 'min_quantity'),
     search_fields=('product__name', 'product__description', '_unit_price'),
     can_delete=False,
     )
 
+admin.site.register(models.VariationSyncJob,
+    admin_class=ReadonlyModelAdmin,
+    list_display=('__unicode__', 'created', 'status', 'products_done',
+        'products_total', 'variations_created'),
+    list_filter=('status',),
+    readonly_fields=('created', 'status', 'option', 'product', 'products_total',
+        'products_done', 'variations_created', 'last_product_id', 'error'),
+    )
+
 admin.site.register(models.ProductVariation,
     admin_class=ReadonlyModelAdmin,
-    list_display=('__unicode__', 'is_active', 'sku', 'items_in_stock', 'ordering'),
+    list_display=('__unicode__', 'is_active', 'sku', 'items_in_stock',
+        'items_reserved', 'ordering'),
     list_filter=('is_active',),
-    readonly_fields=('product', 'is_active', 'sku', 'items_in_stock', 'options', 'ordering'),
+    readonly_fields=('product', 'is_active', 'sku', 'items_in_stock',
+        'items_reserved', 'options', 'ordering'),
     search_fields=('sku', 'product__name', 'product__description'),
     )
+
+admin.site.register(models.StockReservation,
+    admin_class=ReadonlyModelAdmin,
+    list_display=('variation', 'order', 'quantity', 'expires'),
+    readonly_fields=('variation', 'order', 'quantity', 'expires'),
+    search_fields=('variation__sku',),
+    )
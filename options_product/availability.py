@@ -0,0 +1,108 @@
+"""
+Availability of combinations of options
+
+An ``AvailabilityIndex`` stores one bitset per option: Bit ``n`` is set if
+the ``n``-th active variation of the product has this option. The variations
+matching a (partial) selection of options are the bitwise AND of the bitsets
+of the selected options, which allows variation pickers to determine the
+options which can still be chosen without touching the database.
+
+Bitsets are plain Python integers. ``describe`` encodes them as hexadecimal
+strings, because JavaScript numbers cannot represent more than 53 bits.
+"""
+
+
+class AvailabilityIndex(object):
+    def __init__(self, variations, options, in_stock):
+        """
+        ``variations`` is the list of variation primary keys, ``options``
+        maps option primary keys to ``(group_id, bitset)`` tuples and
+        ``in_stock`` is the bitset of variations with items in stock
+        """
+        self.variations = list(variations)
+        self.options = options
+        self.in_stock = in_stock
+        self.all = (1 << len(self.variations)) - 1
+
+    @classmethod
+    def for_product(cls, product):
+        """
+        Builds the index of the active variations of the product with a
+        single query. Variations count as in stock if they have items which
+        are not reserved for carts.
+        """
+        variations = []
+        bits = {}
+        options = {}
+        in_stock = 0
+        for variation_id, items_in_stock, items_reserved, option_id, group_id in \
+                product.variations.filter(is_active=True).order_by('ordering', 'id'
+                ).values_list('id', 'items_in_stock', 'items_reserved', 'options__id',
+                'options__group'):
+            if variation_id not in bits:
+                bits[variation_id] = 1 << len(variations)
+                variations.append(variation_id)
+                if items_in_stock > items_reserved:
+                    in_stock |= bits[variation_id]
+
+            if option_id is not None:
+                group_id, bitset = options.get(option_id, (group_id, 0))
+                options[option_id] = (group_id, bitset | bits[variation_id])
+
+        return cls(variations, options, in_stock)
+
+    def matching(self, selection, in_stock=False):
+        """
+        Returns the bitset of variations containing all options in
+        ``selection`` (options or option primary keys)
+        """
+        mask = in_stock and self.in_stock or self.all
+        for option in selection:
+            mask &= self.options.get(getattr(option, 'pk', option), (None, 0))[1]
+        return mask
+
+    def variations_for(self, selection, in_stock=False):
+        """
+        Returns the primary keys of the variations containing all options
+        in ``selection``
+        """
+        mask = self.matching(selection, in_stock)
+        return [pk for bit, pk in enumerate(self.variations) if mask >> bit & 1]
+
+    def available_options(self, selection=(), in_stock=False):
+        """
+        Returns the set of primary keys of options which can be chosen
+        together with ``selection``
+
+        The selected option of a group does not restrict the other options
+        of the same group, so that users are able to change their choice.
+        """
+        selection = [getattr(option, 'pk', option) for option in selection]
+        masks = {}
+        available = set()
+        for option_id, (group_id, bitset) in self.options.items():
+            if group_id not in masks:
+                masks[group_id] = self.matching([pk for pk in selection
+                    if self.options.get(pk, (None,))[0] != group_id], in_stock)
+            if bitset & masks[group_id]:
+                available.add(option_id)
+        return available
+
+    def describe(self):
+        """
+        Returns a JSON serializable description of the index, which can be
+        passed to ``from_description``
+        """
+        return {
+            'variations': self.variations,
+            'options': dict((str(pk), {'group': group_id, 'bits': '%x' % bitset})
+                for pk, (group_id, bitset) in self.options.items()),
+            'in_stock': '%x' % self.in_stock,
+            }
+
+    @classmethod
+    def from_description(cls, description):
+        return cls(description['variations'],
+            dict((int(pk), (option['group'], int(option['bits'], 16)))
+                for pk, option in description['options'].items()),
+            int(description['in_stock'], 16))
@@ -0,0 +1,444 @@
+"""
+Two-tier caching for product data
+
+Reading prices from the Django cache costs a network round trip every
+time, even if the same product is priced several times while handling a
+single request. ``TieredCache`` puts a small, bounded process-local LRU
+cache in front of the Django cache. Entries in the local tier expire after
+a few seconds (``OPTIONS_PRODUCT_LOCAL_CACHE_TIMEOUT``), which bounds the
+time other processes may serve values which have been invalidated
+elsewhere. Set ``OPTIONS_PRODUCT_LOCAL_CACHE_PER_REQUEST = True`` to
+additionally empty the local tier whenever a request starts.
+
+Values in the local tier are shared between all users of the cache in the
+current process and must be treated as immutable.
+
+``TieredCache.get_or_compute`` protects expensive values against cache
+stampedes: When a value is missing, only the process which manages to
+acquire a short-lived lock key recomputes it. Everyone else is served the
+last known (stale) value in the meantime, or waits a short time for the
+new value if there is no stale value.
+
+Whole classes of cached values can be invalidated at once by including
+generation counters (see ``TieredCache.generations``) in their keys. Keys
+may carry such a version suffix, separated by ``@``; stale copies are
+stored per unversioned key, so that they survive invalidation.
+
+Invalidations through ``TieredCache.invalidate`` are collected while a
+``deferred_invalidation`` block is active and sent as one ``delete_many``
+per cache when the outermost block is left. Wrap database transactions
+with it (outside of ``transaction.commit_on_success``), so that other
+processes cannot cache uncommitted data again before the transaction
+commits, or add ``DeferredInvalidationMiddleware`` to do this for every
+request::
+
+    @deferred_invalidation()
+    @transaction.commit_on_success
+    def import_prices():
+        ...
+
+Generations which are pending invalidation are not read from the cache
+inside the block, so that the current thread sees its own changes. Values
+whose keys contain such a generation are computed, but never stored, so
+that uncommitted data does not leak to other processes.
+"""
+
+import threading
+from time import sleep, time
+
+try:
+    from functools import wraps
+except ImportError:
+    from django.utils.functional import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import got_request_exception, request_started
+
+from options_product.compat import OrderedDict
+
+
+class LocalCache(object):
+    """
+    Bounded, thread-safe LRU cache whose entries expire after ``timeout``
+    seconds
+    """
+
+    def __init__(self, max_entries=1000, timeout=10):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+
+            if expires < time():
+                return default
+
+            # Move the entry to the end of the LRU list
+            self._data[key] = (expires, value)
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, timeout=None):
+        timeout = min(self.timeout, timeout or self.timeout)
+        if timeout <= 0:
+            return
+
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = (time() + timeout, value)
+
+            while len(self._data) > self.max_entries:
+                del self._data[iter(self._data).next()]
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+
+#: Marks generations which are pending invalidation
+PENDING_GENERATION = '-pending'
+
+
+class TieredCache(object):
+    """
+    Process-local ``LocalCache`` in front of a shared Django cache backend
+
+    Offers a subset of the Django cache API. ``None`` cannot be cached.
+    The ``stats`` dictionary counts local hits, shared hits, misses and
+    stale values returned by ``get_or_compute``.
+    """
+
+    def __init__(self, local, shared, lock_timeout=10, lock_wait=1.0,
+            stale_timeout=None):
+        self.local = local
+        self.shared = shared
+        self.lock_timeout = lock_timeout
+        self.lock_wait = lock_wait
+        self.stale_timeout = stale_timeout
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0,
+            'stale_hits': 0}
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self.stats['local_hits'] += 1
+            return value
+
+        value = self.shared.get(key)
+        if value is None:
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['shared_hits'] += 1
+        self.local.set(key, value)
+        return value
+
+    def get_many(self, keys):
+        values = {}
+        missing = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                values[key] = value
+
+        self.stats['local_hits'] += len(values)
+
+        if missing:
+            shared = self.shared.get_many(missing)
+            for key, value in shared.items():
+                self.local.set(key, value)
+
+            values.update(shared)
+            self.stats['shared_hits'] += len(shared)
+            self.stats['misses'] += len(missing) - len(shared)
+
+        return values
+
+    def get_or_compute(self, key, compute, validate=None):
+        """
+        Returns the value for ``key``, calling ``compute`` to determine and
+        store it if it is missing, or if ``validate`` is given and returns
+        ``False`` for the cached value. ``compute`` has to return a
+        ``(value, timeout)`` tuple.
+
+        Only one process computes a missing value at a time; the others
+        return the last known value during that time (see ``set`` and
+        ``set_many``). If there is no stale value, they poll for the new
+        value for up to ``lock_wait`` seconds before computing the value
+        themselves.
+        """
+        if self.is_pending(key):
+            return compute()[0]
+
+        value = self.get(key)
+        if value is not None and (validate is None or validate(value)):
+            return value
+
+        lock_key = '%s:lock' % key
+
+        locked = self.shared.add(lock_key, 1, self.lock_timeout)
+        if not locked:
+            value = self.shared.get(self.stale_key(key))
+            if value is not None:
+                self.stats['stale_hits'] += 1
+                return value
+
+            waited = 0
+            while waited < self.lock_wait:
+                sleep(0.05)
+                waited += 0.05
+
+                value = self.shared.get(key)
+                if value is not None and (validate is None or validate(value)):
+                    self.local.set(key, value)
+                    return value
+
+        try:
+            value, timeout = compute()
+            self.set(key, value, timeout, stale=True)
+        finally:
+            # The lock of another process is left alone, it expires after
+            # lock_timeout seconds
+            if locked:
+                self.shared.delete(lock_key)
+
+        return value
+
+    def stale_key(self, key):
+        return '%s:stale' % key.split('@')[0]
+
+    def is_pending(self, key):
+        """
+        Returns whether the key contains a generation which is pending
+        invalidation (see ``generations``)
+        """
+        return PENDING_GENERATION in key.partition('@')[2]
+
+    def set(self, key, value, timeout=None, stale=False):
+        """
+        Stores the value in both tiers. If ``stale`` is ``True``, a copy
+        which survives ``delete`` is kept for ``get_or_compute``. Keys
+        containing pending generations are not stored at all.
+        """
+        if self.is_pending(key):
+            return
+
+        self.shared.set(key, value, timeout)
+        self.local.set(key, value, timeout)
+        if stale:
+            self.shared.set(self.stale_key(key), value, self.stale_timeout)
+
+    def set_many(self, data, timeout=None, stale=False):
+        data = dict((key, value) for key, value in data.items()
+            if not self.is_pending(key))
+        if not data:
+            return
+
+        self.shared.set_many(data, timeout)
+        for key, value in data.items():
+            self.local.set(key, value, timeout)
+        if stale:
+            self.shared.set_many(dict((self.stale_key(key), value)
+                for key, value in data.items()), self.stale_timeout)
+
+    def delete(self, key):
+        self.local.delete(key)
+        self.shared.delete(key)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.local.delete(key)
+        self.shared.delete_many(keys)
+
+    def generations(self, keys):
+        """
+        Returns a dictionary containing the current values of the generation
+        counters ``keys``
+
+        Missing counters are initialized with the current time in
+        milliseconds, so that a counter which has been deleted (or evicted)
+        does not return to a value it had before unless it has been
+        incremented more than once per millisecond. Generation lookups are
+        not counted in ``stats``.
+        """
+        values = {}
+        pending = (_pending_invalidations() or {}).get(self, ())
+        for key in keys:
+            if key in pending:
+                # Use a throwaway generation until the invalidation is sent
+                values[key] = '%s%s' % (int(time() * 1000), PENDING_GENERATION)
+                continue
+
+            value = self.local.get(key)
+            if value is not None:
+                values[key] = value
+
+        missing = [key for key in keys if key not in values]
+        if missing:
+            shared = self.shared.get_many(missing)
+            for key, value in shared.items():
+                self.local.set(key, value)
+            values.update(shared)
+
+        for key in keys:
+            if key not in values:
+                value = int(time() * 1000)
+                if not self.shared.add(key, value, self.stale_timeout):
+                    value = self.shared.get(key) or value
+                self.local.set(key, value)
+                values[key] = value
+        return values
+
+    def invalidate(self, keys):
+        """
+        Deletes ``keys`` now, or when the outermost ``deferred_invalidation``
+        block of the current thread is left
+        """
+        batch = _pending_invalidations()
+        if batch is None:
+            self.delete_many(keys)
+        else:
+            batch.setdefault(self, set()).update(keys)
+
+    def incr_generation(self, key):
+        """
+        Invalidates all values whose keys include the generation ``key``
+        """
+        self.local.delete(key)
+        try:
+            self.shared.incr(key)
+        except ValueError:
+            # The counter will be initialized with a new value when it is
+            # used the next time
+            pass
+
+
+_state = threading.local()
+
+
+def _pending_invalidations():
+    return getattr(_state, 'pending', None)
+
+
+class deferred_invalidation(object):
+    """
+    Collects invalidations of the current thread and sends them, de-duplicated,
+    when the outermost block is left. Can be used as context manager or
+    as decorator.
+    """
+
+    def __enter__(self):
+        _state.depth = getattr(_state, 'depth', 0) + 1
+        if _state.depth == 1:
+            _state.pending = {}
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        _state.depth -= 1
+        if _state.depth:
+            return
+
+        pending, _state.pending = _state.pending, None
+        # Also invalidate after rollbacks; the current thread might have
+        # cached data which has never been committed
+        for cache, keys in pending.items():
+            cache.delete_many(list(keys))
+
+    def __call__(self, func):
+        @wraps(func)
+        def _fn(*args, **kwargs):
+            self.__enter__()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.__exit__()
+        return _fn
+
+
+class DeferredInvalidationMiddleware(object):
+    """
+    Runs every request in a ``deferred_invalidation`` block
+
+    Has to be added before ``TransactionMiddleware`` to ``MIDDLEWARE_CLASSES``,
+    so that invalidations are sent after the transaction has been committed.
+    """
+
+    def process_request(self, request):
+        flush_deferred_invalidations()
+        deferred_invalidation().__enter__()
+
+    def process_response(self, request, response):
+        flush_deferred_invalidations()
+        return response
+
+
+def flush_deferred_invalidations(**kwargs):
+    """
+    Leaves all open ``deferred_invalidation`` blocks of the current thread
+    and sends their invalidations. Connected to ``got_request_exception``
+    because requests raising exceptions never reach ``process_response``.
+    """
+    while getattr(_state, 'depth', 0):
+        deferred_invalidation().__exit__()
+
+got_request_exception.connect(flush_deferred_invalidations)
+
+
+local_cache = LocalCache(
+    max_entries=getattr(settings, 'OPTIONS_PRODUCT_LOCAL_CACHE_ENTRIES', 1000),
+    timeout=getattr(settings, 'OPTIONS_PRODUCT_LOCAL_CACHE_TIMEOUT', 10),
+    )
+
+#: Cache used for product prices
+price_cache = TieredCache(local_cache, cache,
+    lock_timeout=getattr(settings, 'OPTIONS_PRODUCT_CACHE_LOCK_TIMEOUT', 10),
+    stale_timeout=getattr(settings, 'OPTIONS_PRODUCT_PRICE_CACHE_TIMEOUT', 30 * 86400),
+    )
+
+#: Cache used for the stock of product variations
+stock_cache = TieredCache(local_cache, cache,
+    lock_timeout=getattr(settings, 'OPTIONS_PRODUCT_CACHE_LOCK_TIMEOUT', 10),
+    stale_timeout=getattr(settings, 'OPTIONS_PRODUCT_STOCK_CACHE_TIMEOUT', 86400),
+    )
+
+#: Cache used for the option groups and options of products
+option_cache = TieredCache(local_cache, cache,
+    lock_timeout=getattr(settings, 'OPTIONS_PRODUCT_CACHE_LOCK_TIMEOUT', 10),
+    stale_timeout=getattr(settings, 'OPTIONS_PRODUCT_OPTION_CACHE_TIMEOUT', 86400),
+    )
+
+
+def clear_local_cache(**kwargs):
+    local_cache.clear()
+
+if getattr(settings, 'OPTIONS_PRODUCT_LOCAL_CACHE_PER_REQUEST', False):
+    request_started.connect(clear_local_cache)
@@ -0,0 +1,101 @@
+"""
+Whole-cart stock and price validation
+
+``order_lines`` determines the available stock and the current price of
+every line of an order with a fixed number of queries, however many lines
+the order has. ``validate_order_lines`` is an order validator built on top
+of it, which can be registered with plata::
+
+    from plata.shop.models import Order
+    from options_product.checkout import validate_order_lines
+
+    Order.register_validator(validate_order_lines, Order.VALIDATE_CART)
+"""
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.utils.translation import ugettext as _
+
+from options_product.models import Product, StockReservation, \
+    invalidate_product_stock, recount_items_in_stock, stock_held_by_order
+
+
+def order_lines(order):
+    """
+    Returns a list of dictionaries containing the ``item``, the
+    ``variation``, the number of items ``available`` for the order and the
+    current ``price`` (a ``CachedPrice``, or ``None`` if the variation has no
+    price in the order's currency) for every item of the order
+
+    Availability is determined from the ``items_in_stock`` and
+    ``items_reserved`` counters of the variations, adding back the items
+    reserved for this order and its own unexpired stock transactions. The
+    ``items_in_stock`` counters of variations with expired payment process
+    reservations are recomputed first. Prices are resolved through
+    ``Product.get_prices_bulk``, including quantity tiers.
+    """
+    items = list(order.items.select_related('product__product'))
+    if not items:
+        return []
+
+    variations = [item.product for item in items]
+    products = dict((variation.product_id, variation.product)
+        for variation in variations)
+    Product.get_prices_bulk(products.values())
+
+    own = dict(StockReservation.objects.filter(order=order).values_list(
+        'variation', 'quantity'))
+
+    # Stock transactions of the order, f.e. payment process reservations
+    for variation_id, held in stock_held_by_order(order).items():
+        own[variation_id] = own.get(variation_id, 0) + held
+
+    if 'plata.product.stock' in settings.INSTALLED_APPS:
+        from plata.product.stock.models import StockTransaction
+
+        # items_in_stock still includes expired payment process reservations
+        # until they are released
+        stale = set(StockTransaction.objects.expired().filter(
+            product__in=[variation.pk for variation in variations]).values_list(
+            'product', flat=True))
+        if stale:
+            counts = recount_items_in_stock(stale)
+            invalidate_product_stock(set(variation.product_id
+                for variation in variations if variation.pk in stale))
+            for variation in variations:
+                variation.items_in_stock = counts.get(variation.pk,
+                    variation.items_in_stock)
+
+    lines = []
+    for item, variation in zip(items, variations):
+        # Variations of the same product share the instance with the prices
+        variation.product = products[variation.product_id]
+        try:
+            price = variation.product.get_price(currency=order.currency,
+                quantity=item.quantity)
+        except ObjectDoesNotExist:
+            price = None
+
+        lines.append({
+            'item': item,
+            'variation': variation,
+            'available': max(variation.items_in_stock - variation.items_reserved
+                + own.get(variation.pk, 0), 0),
+            'price': price,
+            })
+    return lines
+
+
+def validate_order_lines(order):
+    """
+    Order validator checking the stock and the prices of all lines at once
+    """
+    for line in order_lines(order):
+        if line['item'].quantity > line['available']:
+            raise ValidationError(
+                _('Not enough stock available for %s.') % line['variation'],
+                code='insufficient_stock')
+        if line['price'] is None:
+            raise ValidationError(
+                _('Price could not be determined for %s.') % line['variation'],
+                code='price_missing')
@@ -0,0 +1,154 @@
+"""
+Combinations of options
+
+A ``CombinationSpace`` describes all variations a product can have: One
+option out of each of the product's option groups. It only stores the
+option groups and their options, so it stays small even if the number of
+combinations runs into the millions.
+
+Combinations are numbered in the order ``itertools.product`` would
+generate them, that is, like a mixed-radix number where every option group
+is a digit and the last group changes fastest. The position of a
+combination can be computed from its options and vice versa without
+enumerating the combinations before it, which allows processing the space
+in chunks starting anywhere.
+"""
+
+
+class CombinationSpace(object):
+    def __init__(self, groups):
+        """
+        ``groups`` is a list of ``(group_id, [option, ...])`` tuples
+        """
+        self.groups = [(group_id, list(options)) for group_id, options in groups]
+
+        # Maps option primary keys to (digit, value)
+        self._positions = {}
+        for digit, (group_id, options) in enumerate(self.groups):
+            for value, option in enumerate(options):
+                self._positions[option.pk] = (digit, value)
+
+        # Place values of all digits
+        self._weights = []
+        weight = 1
+        for group_id, options in reversed(self.groups):
+            self._weights.insert(0, weight)
+            weight *= len(options)
+        self._length = weight
+
+    @classmethod
+    def for_product(cls, product):
+        """
+        Loads the option groups of the product and their options with two
+        queries
+        """
+        from options_product.models import Option
+
+        group_ids = list(product.option_groups.values_list('id', flat=True))
+        options = dict((group_id, []) for group_id in group_ids)
+        for option in Option.objects.filter(group__in=group_ids):
+            options[option.group_id].append(option)
+        return cls([(group_id, options[group_id]) for group_id in group_ids])
+
+    @property
+    def option_ids(self):
+        return set(self._positions)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return self.iterate()
+
+    def combination_at(self, index):
+        """
+        Returns the combination at the given position as tuple of options
+        """
+        if not 0 <= index < self._length:
+            raise IndexError('Combination index out of range')
+
+        combination = []
+        for (group_id, options), weight in zip(self.groups, self._weights):
+            value, index = divmod(index, weight)
+            combination.append(options[value])
+        return tuple(combination)
+
+    def index_of(self, options):
+        """
+        Returns the position of the combination consisting of the given
+        options or option primary keys, in any order. Raises ``ValueError``
+        if the options do not form a combination.
+        """
+        options = list(options)
+        if not self.is_valid(options):
+            raise ValueError('%r is not a combination of this space' % (options,))
+
+        index = 0
+        for option in options:
+            digit, value = self._positions[getattr(option, 'pk', option)]
+            index += value * self._weights[digit]
+        return index
+
+    def iterate(self, start=0, stop=None):
+        """
+        Yields the combinations from ``start`` up to (but not including)
+        ``stop``
+
+        Only the first combination is computed from its position, the
+        following combinations are derived by incrementing the previous one.
+        """
+        start, stop, step = slice(start, stop).indices(self._length)
+        if start >= stop:
+            return
+
+        digits = [self._positions[option.pk][1] for option in self.combination_at(start)]
+        sizes = [len(options) for group_id, options in self.groups]
+
+        for index in xrange(start, stop):
+            yield tuple(options[value] for (group_id, options), value in
+                zip(self.groups, digits))
+
+            # Increment, carrying over into the previous digits
+            digit = len(digits) - 1
+            while digit >= 0:
+                digits[digit] += 1
+                if digits[digit] < sizes[digit]:
+                    break
+                digits[digit] = 0
+                digit -= 1
+
+    def chunks(self, size, start=0):
+        """
+        Yields ``(offset, combinations)`` tuples with lists of at most ``size``
+        combinations, starting at position ``start``
+        """
+        for offset in xrange(start, self._length, size):
+            yield offset, list(self.iterate(offset, offset + size))
+
+    def fix(self, option):
+        """
+        Returns the space of all combinations containing the given option
+        """
+        digit, value = self._positions[getattr(option, 'pk', option)]
+        groups = list(self.groups)
+        groups[digit] = (groups[digit][0], [groups[digit][1][value]])
+        return self.__class__(groups)
+
+    def is_valid(self, options):
+        """
+        Returns whether the given options form a combination, that is,
+        contain exactly one option of every group
+        """
+        digits = [self._positions.get(getattr(option, 'pk', option), (None,))[0]
+            for option in options]
+        return (None not in digits
+            and len(digits) == len(self.groups)
+            and len(set(digits)) == len(digits))
+
+    def describe(self):
+        """
+        Returns a compact, JSON serializable description of the space: A
+        list of option groups with the primary keys of their options
+        """
+        return [{'id': group_id, 'options': [option.pk for option in options]}
+            for group_id, options in self.groups]
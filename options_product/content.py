@@ -79,7 +79,10 @@ class ProductList(models.Model):
         if self.only_sale:
             shop = plata.shop_instance()
             currency = shop.default_currency(request=request)
-            products = [p for p in products if p.in_sale(currency)]
+            if hasattr(products, 'in_sale'):
+                products = products.in_sale(currency)
+            else:
+                products = [p for p in products if p.in_sale(currency)]
 
         my_ctx = {'content': self, 'object_list': products}
 
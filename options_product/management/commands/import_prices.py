@@ -0,0 +1,60 @@
+import os
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from options_product.price_import import READERS, PriceImportError, import_prices
+
+
+class Command(BaseCommand):
+    help = ('Imports product prices from CSV or JSON Lines files.'
+        ' Use - to read from standard input.')
+    args = 'file [file ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format', default=None,
+            help='Format of the files (%s). Determined by the file extension'
+                ' by default.' % ', '.join(sorted(READERS))),
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=500,
+            help='Number of rows processed per batch. Defaults to 500.'),
+        make_option('--keep-superseded', action='store_false', dest='supersede',
+            default=True,
+            help='Do not deactivate prices superseded by imported prices.'),
+        )
+
+    def handle(self, *files, **options):
+        if not files:
+            raise CommandError('Enter at least one file to import.')
+
+        verbosity = int(options.get('verbosity', 1))
+
+        for name in files:
+            format = options.get('format') or os.path.splitext(name)[1].lstrip('.')
+            if format not in READERS:
+                raise CommandError('Unknown format %r of %s.' % (format, name))
+
+            if name == '-':
+                fileobj = sys.stdin
+            else:
+                fileobj = open(name, 'rb')
+
+            try:
+                try:
+                    result = import_prices(READERS[format](fileobj),
+                        batch_size=options.get('batch_size'),
+                        supersede=options.get('supersede'))
+                except PriceImportError, e:
+                    raise CommandError('%s: %s' % (name, e))
+            finally:
+                if fileobj is not sys.stdin:
+                    fileobj.close()
+
+            if verbosity:
+                sys.stdout.write('%s: Imported %s prices.\n' % (
+                    name, result['imported']))
+                if result['unknown_skus']:
+                    sys.stdout.write((u'%s: Skipped unknown SKUs: %s\n' % (
+                        name, u', '.join(sorted(unicode(sku) for sku in
+                            result['unknown_skus'])))).encode('utf-8'))
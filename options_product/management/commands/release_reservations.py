@@ -0,0 +1,43 @@
+import sys
+from optparse import make_option
+from time import time
+
+from django.core.management.base import NoArgsCommand
+
+from options_product.models import StockReservation
+from options_product.sweeper import sweep_payment_reservations
+
+
+class Command(NoArgsCommand):
+    help = ('Releases expired cart reservations and expired payment process'
+        ' reservations of product variations.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=500,
+            help='Number of reservations released per transaction. Defaults to 500.'),
+        )
+
+    def handle_noargs(self, **options):
+        batch_size = options.get('batch_size')
+        verbosity = int(options.get('verbosity', 1))
+
+        for name, batches in (
+                ('cart reservations',
+                    StockReservation.objects.sweep(batch_size=batch_size)),
+                ('payment process reservations',
+                    sweep_payment_reservations(batch_size=batch_size)),
+                ):
+            total, count, start = 0, 0, time()
+            batch_start = start
+            for released in batches:
+                count += 1
+                total += released
+                if verbosity:
+                    sys.stdout.write('Batch %s: %s %s released in %.3fs.\n' % (
+                        count, released, name, time() - batch_start))
+                batch_start = time()
+
+            if verbosity:
+                sys.stdout.write('%s %s released in %s batches (%.3fs).\n' % (
+                    total, name, count, time() - start))
@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from options_product.models import sync_options_signatures
+
+
+class Command(NoArgsCommand):
+    help = ('Recomputes the options signature of all product variations.'
+        ' Run this once after adding the options_signature column.')
+
+    def handle_noargs(self, **options):
+        transaction.commit_on_success(sync_options_signatures)()
@@ -0,0 +1,47 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from options_product.models import VariationSyncJob
+
+
+class Command(NoArgsCommand):
+    help = ('Processes pending variation sync jobs, creating variations for'
+        ' new options and changed option groups.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=100,
+            help='Number of products processed per transaction. Defaults to 100.'),
+        make_option('--retry-failed', action='store_true', dest='retry_failed',
+            default=False,
+            help='Resume failed jobs too.'),
+        )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options.get('batch_size')
+
+        if options.get('retry_failed'):
+            VariationSyncJob.objects.filter(status=VariationSyncJob.FAILED).update(
+                status=VariationSyncJob.RUNNING, error='')
+
+        process = transaction.commit_on_success(
+            lambda job: job.process(batch_size=batch_size))
+
+        for job in VariationSyncJob.objects.pending():
+            try:
+                while not process(job):
+                    if verbosity > 1:
+                        sys.stdout.write((u'%s\n' % job).encode('utf-8'))
+            except Exception, e:
+                # Record the error and continue with the next job
+                job.fail(e)
+                sys.stderr.write((u'%s failed: %s\n' % (job, e)).encode('utf-8'))
+                continue
+
+            if verbosity:
+                sys.stdout.write((u'%s, %s variations created\n' % (
+                    job, job.variations_created)).encode('utf-8'))
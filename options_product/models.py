@@ -2,19 +2,24 @@
 This module contains the original product model of Plata
 """
 
-from datetime import date
+from bisect import bisect_right
+from datetime import date, datetime, time, timedelta
 
 from django.conf import settings
-from django.core.cache import cache
-from django.db import models
-from django.db.models import Count, Q, signals
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Count, Q, Sum, signals
+from django.utils import simplejson
 from django.utils.translation import ugettext_lazy as _
 
 import plata
 from plata.product.models import ProductBase
-from plata.shop.models import Order, PriceBase
+from plata.shop.models import Order, OrderItem, PriceBase, TaxClass
 
-from options_product.compat import product as itertools_product
+from options_product.availability import AvailabilityIndex
+from options_product.caching import option_cache, price_cache, stock_cache
+from options_product.combinations import CombinationSpace
+from options_product.utils import bulk_delete, bulk_increment, bulk_insert, \
+    bulk_update, chunked
 
 
 class CategoryManager(models.Manager):
@@ -104,13 +109,159 @@ class Option(models.Model):
         return u'%s - %s' % (self.group, self.name)
 
 
-class ProductManager(models.Manager):
+class ProductQuerySet(models.query.QuerySet):
+    _with_prices = False
+
+    def _clone(self, *args, **kwargs):
+        c = super(ProductQuerySet, self)._clone(*args, **kwargs)
+        c._with_prices = self._with_prices
+        return c
+
+    def iterator(self):
+        iterator = super(ProductQuerySet, self).iterator()
+        if not self._with_prices:
+            return iterator
+
+        products = list(iterator)
+        self.model.get_prices_bulk(products)
+        return iter(products)
+
     def active(self):
         return self.filter(is_active=True)
 
     def featured(self):
         return self.active().filter(is_featured=True)
 
+    def in_sale(self, currency):
+        """
+        Only return products which are in sale in the given currency
+
+        This is the SQL equivalent of ``Product.in_sale``: An active sale
+        price must exist, and it must not be older than the newest active
+        normal price. Quantity tiers are not taken into account.
+        """
+        qn = connection.ops.quote_name
+        opts = ProductPrice._meta
+        today = connection.ops.value_to_db_date(date.today())
+
+        def active(alias):
+            return (u'%(alias)s.%(is_active)s = %%s'
+                u' AND %(alias)s.%(valid_from)s <= %%s'
+                u' AND (%(alias)s.%(valid_until)s IS NULL OR %(alias)s.%(valid_until)s >= %%s)'
+                u' AND %(alias)s.%(currency)s = %%s'
+                u' AND %(alias)s.%(is_sale)s = %%s'
+                u' AND %(alias)s.%(min_quantity)s <= 1') % dict(
+                    [(f, qn(opts.get_field(f).column)) for f in (
+                        'is_active', 'valid_from', 'valid_until', 'currency', 'is_sale',
+                        'min_quantity')],
+                    alias=alias)
+
+        sql = (u'EXISTS (SELECT 1 FROM %(table)s sale WHERE sale.%(product)s = %(product_pk)s'
+            u' AND %(active_sale)s AND NOT EXISTS (SELECT 1 FROM %(table)s normal'
+            u' WHERE normal.%(product)s = sale.%(product)s AND %(active_normal)s'
+            u' AND normal.%(valid_from)s > sale.%(valid_from)s))') % {
+                'table': qn(opts.db_table),
+                'product': qn(opts.get_field('product').column),
+                'product_pk': u'%s.%s' % (qn(self.model._meta.db_table),
+                    qn(self.model._meta.pk.column)),
+                'valid_from': qn(opts.get_field('valid_from').column),
+                'active_sale': active('sale'),
+                'active_normal': active('normal'),
+                }
+
+        return self.extra(where=[sql], params=[
+            True, today, today, currency, True,
+            True, today, today, currency, False,
+            ])
+
+    def with_prices(self):
+        """
+        Resolve the prices of all products in one go when the queryset is
+        evaluated, see ``Product.get_prices_bulk``
+        """
+        c = self._clone()
+        c._with_prices = True
+        return c
+
+    def for_detail(self, pk):
+        """
+        Returns the product with the given primary key together with all
+        data needed by product detail pages, using a constant number of
+        queries regardless of the number of option groups and variations
+
+        The following attributes are set on the product:
+
+        - ``detail_option_groups``: Option groups, each with a
+          ``detail_options`` list of its options
+        - ``detail_variations``: Variations, each with a ``detail_options``
+          list of its options
+        - ``detail_images`` and ``detail_categories``
+
+        Prices and the main image are attached too, so that ``get_price``
+        and ``main_image`` do not issue queries of their own. The producer is
+        loaded with ``select_related`` if the producer app is installed.
+        """
+        queryset = self
+        if 'producer' in [f.name for f in self.model._meta.fields]:
+            queryset = queryset.select_related('producer')
+        product = queryset.get(pk=pk)
+
+        groups = list(OptionGroup.objects.filter(products=product))
+        options = {}
+        for group in groups:
+            group.detail_options = []
+        groups_by_id = dict((group.pk, group) for group in groups)
+        for option in Option.objects.filter(group__in=groups_by_id.keys()):
+            groups_by_id[option.group_id].detail_options.append(option)
+            options[option.pk] = option
+
+        variations = list(product.variations.all())
+        variations_by_id = {}
+        for variation in variations:
+            variation.product = product
+            variation.detail_options = []
+            variations_by_id[variation.pk] = variation
+
+        field = ProductVariation._meta.get_field('options')
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
+        for row in field.rel.through._default_manager.filter(**{
+                '%s__product' % source: product}).select_related(target).order_by(
+                '%s__group' % target, '%s__ordering' % target):
+            option = getattr(row, target)
+            variations_by_id[getattr(row, '%s_id' % source)].detail_options.append(
+                options.get(option.pk, option))
+
+        images = list(product.images.all())
+        product._main_image = images and images[0] or None
+        product.detail_images = images
+
+        product.detail_option_groups = groups
+        product.detail_variations = variations
+        product.detail_categories = list(product.categories.all())
+        self.model.get_prices_bulk([product])
+        return product
+
+
+class ProductManager(models.Manager):
+    def get_query_set(self):
+        return ProductQuerySet(self.model, using=self._db)
+
+    def active(self):
+        return self.get_query_set().active()
+
+    def featured(self):
+        return self.get_query_set().featured()
+
+    def in_sale(self, currency):
+        return self.get_query_set().in_sale(currency)
+
+    def with_prices(self):
+        return self.get_query_set().with_prices()
+
+    def for_detail(self, pk):
+        return self.get_query_set().for_detail(pk)
+
     def bestsellers(self, queryset=None):
         queryset = queryset or self
         return queryset.filter(
@@ -123,6 +274,165 @@ class ProductManager(models.Manager):
                 ).filter(variations__orderitem__order__items__product__product=product))
 
 
+def price_generation_key(scope):
+    return 'product-prices-generation-%s' % scope
+
+
+def price_cache_keys(pks):
+    """
+    Returns a tuple consisting of a dictionary mapping the product primary
+    keys passed to their versioned price cache keys, and a dictionary of the
+    current generations of all currencies
+
+    The key of a product contains the global and the product's generation.
+    Cached prices additionally record the generations of the currencies
+    they contain, see ``price_cache_value``. The global generation is
+    stored per set of configured currencies, which means that changing
+    ``CURRENCIES`` invalidates all cached prices too.
+    """
+    all_key = price_generation_key('all-%s' % '.'.join(plata.settings.CURRENCIES))
+    currencies = dict((currency, price_generation_key('currency-%s' % currency))
+        for currency in plata.settings.CURRENCIES)
+    products = dict((pk, price_generation_key('product-%s' % pk)) for pk in pks)
+
+    generations = price_cache.generations(
+        [all_key] + currencies.values() + products.values())
+
+    return (
+        dict((pk, 'product-prices-%s@%s.%s' % (
+            pk, generations[all_key], generations[key])) for pk, key in products.items()),
+        dict((currency, generations[key]) for currency, key in currencies.items()),
+        )
+
+
+def price_cache_value(prices, currencies):
+    """
+    Wraps the ``get_prices`` data structure for the price cache
+    """
+    return (dict((currency, currencies[currency]) for currency, p in prices), prices)
+
+
+def price_cache_valid(value, currencies):
+    """
+    Returns ``False`` if the generation of one of the currencies in the
+    cached value has changed
+    """
+    for currency, generation in value[0].items():
+        if currencies.get(currency) != generation:
+            return False
+    return True
+
+
+def invalidate_product_prices(pks):
+    """
+    Invalidates the cached prices of the given products, respecting
+    ``deferred_invalidation`` blocks
+    """
+    price_cache.invalidate([price_generation_key('product-%s' % pk) for pk in pks])
+
+
+def invalidate_price_cache(currency=None):
+    """
+    Invalidates the cached prices of all products, or of all products which
+    have prices in the given currency. Use ``Product.flush_price_cache`` to
+    invalidate the prices of a single product.
+    """
+    if currency:
+        price_cache.incr_generation(price_generation_key('currency-%s' % currency))
+    else:
+        price_cache.incr_generation(price_generation_key(
+            'all-%s' % '.'.join(plata.settings.CURRENCIES)))
+
+
+#: Maximum lifetime of cached prices in seconds. Prices are flushed when
+#: they are saved, and ``price_cache_timeout`` takes care of ``valid_from``
+#: and ``valid_until`` boundaries. The default is 30 days, which is the
+#: longest relative expiration time memcached understands.
+PRICE_CACHE_TIMEOUT = getattr(settings, 'OPTIONS_PRODUCT_PRICE_CACHE_TIMEOUT',
+    30 * 86400)
+
+
+def price_cache_timeout(prices, now=None):
+    """
+    Returns the number of seconds until the next ``valid_from`` or
+    ``valid_until`` boundary of the given prices is reached, that is, the
+    time after which ``PriceManager.active`` returns a different set of
+    prices. The result is capped at ``PRICE_CACHE_TIMEOUT``.
+    """
+    now = now or datetime.now()
+    today = now.date()
+
+    boundaries = []
+    for price in prices:
+        if price.valid_from > today:
+            boundaries.append(price.valid_from)
+        if price.valid_until is not None and price.valid_until >= today:
+            # valid_until is inclusive
+            boundaries.append(price.valid_until + timedelta(days=1))
+
+    if not boundaries:
+        return PRICE_CACHE_TIMEOUT
+
+    delta = datetime.combine(min(boundaries), time()) - now
+    return min(delta.days * 86400 + delta.seconds + 1, PRICE_CACHE_TIMEOUT)
+
+
+def stock_generation_key(pk):
+    return 'product-stock-generation-%s' % pk
+
+
+def invalidate_product_stock(pks):
+    """
+    Invalidates the cached stock matrices and availability indexes of the
+    given products, respecting ``deferred_invalidation`` blocks
+    """
+    stock_cache.invalidate([stock_generation_key(pk) for pk in pks])
+
+
+def invalidate_variation_stock(variation):
+    """
+    Invalidates the cached stock data of the product of a variation (or
+    variation primary key), f.e. after changing its counters with ``update``
+    """
+    product_id = getattr(variation, 'product_id', None)
+    if product_id is None:
+        product_id = ProductVariation.objects.filter(pk=variation).values_list(
+            'product', flat=True)[0]
+    invalidate_product_stock([product_id])
+
+
+def option_generation_key(scope):
+    return 'product-options-generation-%s' % scope
+
+
+def invalidate_product_options(pks):
+    """
+    Invalidates the cached option schemas of the given products, respecting
+    ``deferred_invalidation`` blocks
+    """
+    option_cache.invalidate([option_generation_key('product-%s' % pk) for pk in pks])
+
+
+def invalidate_option_cache(**kwargs):
+    """
+    Invalidates the cached option schemas of all products. Connected to
+    changes of option groups and options, which may be shared by many
+    products.
+    """
+    option_cache.incr_generation(option_generation_key('all'))
+
+
+#: Maximum lifetime of cached option schemas in seconds
+OPTION_CACHE_TIMEOUT = getattr(settings, 'OPTIONS_PRODUCT_OPTION_CACHE_TIMEOUT',
+    86400)
+
+
+#: Maximum lifetime of cached stock data in seconds. It is
+#: invalidated whenever variations or stock transactions change.
+STOCK_CACHE_TIMEOUT = getattr(settings, 'OPTIONS_PRODUCT_STOCK_CACHE_TIMEOUT',
+    86400)
+
+
 if settings.OPTIONS_PRODUCT_FEINCMS:
     from feincms.models import create_base_model
     Base = create_base_model(ProductBase)
@@ -149,6 +459,8 @@ class Product(Base):
     description = models.TextField(_('description'), blank=True)
     option_groups = models.ManyToManyField(OptionGroup, related_name='products',
         blank=True, null=True, verbose_name=_('option groups'))
+    sparse_variations = models.BooleanField(_('sparse variations'), default=False,
+        help_text=_('Only create variations when they are added to a cart or receive stock. Use this for products with very many combinations of options.'))
 
     class Meta:
         ordering = ['ordering', 'name']
@@ -179,44 +491,132 @@ class Product(Base):
                 self._main_image = None
         return self._main_image
 
-    def get_price(self, currency=None, orderitem=None):
+    def get_price(self, currency=None, orderitem=None, quantity=None):
+        """
+        Returns the sale price if there is one, the normal price otherwise
+
+        If ``quantity`` (or the quantity of ``orderitem``) reaches a quantity
+        tier, the tier's price is returned instead if it is lower.
+        """
         if currency is None:
             currency = (orderitem.currency if orderitem else
                 plata.shop_instance().default_currency())
+        if quantity is None and orderitem is not None:
+            quantity = orderitem.quantity
 
         prices = dict(self.get_prices()).get(currency, {})
+        price = prices.get('sale') or prices.get('normal')
 
-        if prices.get('sale'):
-            return prices['sale']
-
-        if prices.get('normal'):
-            return prices['normal']
-        elif prices.get('sale'):
-            return prices['sale']
+        if quantity and prices.get('tiers'):
+            breakpoints, tiers = prices['tiers']
+            idx = bisect_right(breakpoints, quantity)
+            if idx and (price is None or tiers[idx - 1].unit_price < price.unit_price):
+                price = tiers[idx - 1]
 
-        raise self.prices.model.DoesNotExist
+        if price is None:
+            raise self.prices.model.DoesNotExist
+        return price
 
     def get_prices(self):
         """
         This method is just for demonstration purposes. It's use in ``get_price``
         above does not mean that its API is stable. It's not even guaranteed
-        to stay. It does not work for more exotic pricing models such as
-        staggered prices at all.
+        to stay.
+
+        Returns a list of ``(currency, prices)`` tuples. ``prices`` contains
+        the ``normal`` and ``sale`` prices and, if there are quantity tiers,
+        ``tiers``: A tuple of the sorted minimum quantities and the tiered
+        prices belonging to them, ready for ``bisect``.
         """
-        key = 'product-prices-%s' % self.pk
+        if hasattr(self, '_prices'):
+            return self._prices
+
+        keys, currencies = price_cache_keys([self.pk])
+
+        def compute():
+            now = datetime.now()
+            prices = [CachedPrice.from_price(price) for price in
+                self.prices.current().select_related('tax_class').order_by('valid_from')]
+            return (price_cache_value(self._build_prices(prices, now.date()), currencies),
+                price_cache_timeout(prices, now))
 
-        if cache.has_key(key):
-            return cache.get(key)
+        return price_cache.get_or_compute(keys[self.pk], compute,
+            lambda value: price_cache_valid(value, currencies))[1]
 
+    @classmethod
+    def get_prices_bulk(cls, products):
+        """
+        Determine the prices of many products at once and attach them to the
+        instances passed, so that ``get_price`` and ``in_sale`` do not have to
+        hit the cache or the database anymore.
+
+        Uses one ``cache.get_many`` call for the generation counters and one
+        for the prices, one query for all products whose prices were not
+        cached yet and one ``cache.set_many`` call per distinct cache expiry
+        time.
+        """
+        products = list(products)
+        if not products:
+            return
+
+        keys, currencies = price_cache_keys([p.pk for p in products])
+        products = dict((keys[p.pk], p) for p in products)
+
+        prices = dict((key, value) for key, value in
+            price_cache.get_many(products.keys()).items()
+            if price_cache_valid(value, currencies))
+
+        missing = dict((key, p) for key, p in products.items() if key not in prices)
+        if missing:
+            now = datetime.now()
+            _prices = {}
+            for price in ProductPrice.objects.current().filter(
+                    product__in=[p.pk for p in missing.values()]).select_related(
+                    'tax_class').order_by('valid_from'):
+                _prices.setdefault(price.product_id, []).append(
+                    CachedPrice.from_price(price))
+
+            # Group cache entries by timeout, so that prices which expire
+            # at the same boundary are stored together
+            fetched = {}
+            for key, p in missing.items():
+                product_prices = _prices.get(p.pk, ())
+                prices[key] = price_cache_value(
+                    cls._build_prices(product_prices, now.date()), currencies)
+                fetched.setdefault(price_cache_timeout(product_prices, now), {})[key] = prices[key]
+
+            for timeout, data in fetched.items():
+                price_cache.set_many(data, timeout, stale=True)
+
+        for key, p in products.items():
+            p._prices = prices[key][1]
+
+    @staticmethod
+    def _build_prices(queryset, today):
+        """
+        Builds the ``get_prices`` data structure from a list of current
+        ``CachedPrice`` records ordered by ``valid_from``, skipping prices
+        which are not active yet
+        """
         _prices = {}
-        for price in self.prices.active().order_by('valid_from'):
+        _tiers = {}
+        for price in queryset:
+            if price.valid_from > today:
+                continue
+
+            if price.min_quantity > 1:
+                # The newest price of every tier wins
+                _tiers.setdefault(price.currency, {})[price.min_quantity] = price
+                continue
+
             # First item is normal price, second is sale price
             _prices.setdefault(price.currency, [None, None])[int(price.is_sale)] = price
 
         prices = []
         for currency in plata.settings.CURRENCIES:
-            p = _prices.get(currency)
-            if not p:
+            p = _prices.get(currency, [None, None])
+            tiers = _tiers.get(currency)
+            if not (p[0] or p[1] or tiers):
                 continue
 
             # Sale prices are only active if they are newer than the newest
@@ -224,20 +624,36 @@ class Product(Base):
             if (p[0] and p[1]) and p[0].valid_from > p[1].valid_from:
                 p[1] = None
 
-            prices.append((currency, {
+            data = {
                 'normal': p[0],
                 'sale': p[1],
-                }))
+                }
+            if tiers:
+                # Ordering more items never makes the unit price go up
+                breakpoints, cheapest = sorted(tiers), []
+                for quantity in breakpoints:
+                    price = tiers[quantity]
+                    if cheapest and cheapest[-1].unit_price <= price.unit_price:
+                        price = cheapest[-1]
+                    cheapest.append(price)
+                data['tiers'] = (tuple(breakpoints), tuple(cheapest))
+            prices.append((currency, data))
 
-        cache.set(key, prices)
         return prices
 
     def flush_price_cache(self):
         """
         Flush cached prices
         """
-        key = 'product-prices-%s' % self.pk
-        cache.delete(key)
+        if hasattr(self, '_prices'):
+            del self._prices
+        invalidate_product_prices([self.pk])
+
+    def flush_stock_cache(self):
+        """
+        Flush the cached stock matrix
+        """
+        invalidate_product_stock([self.pk])
 
     def in_sale(self, currency):
         prices = dict(self.get_prices())
@@ -245,36 +661,251 @@ class Product(Base):
             return True
         return False
 
-    def create_variations(self):
-        variations = itertools_product(*[group.options.all() for group in self.option_groups.all()])
+    def create_variations(self, start=0, stop=None, option=None):
+        """
+        Creates the missing variations for all combinations of the options
+        of the product's option groups and orders all variations by the
+        position of their combination
+
+        Existing variations are identified by their ``options_signature``,
+        ignoring options of groups which have been removed from the product.
+        Takes a constant number of queries regardless of the number of
+        combinations: One to load the option groups, the options and the
+        existing variations each, three to insert the missing variations and
+        their options and one to update ``ordering``.
+
+        ``start`` and ``stop`` restrict the work to a range of positions in
+        the ``CombinationSpace``, so that products with many combinations
+        can be processed in chunks. Pass an ``option`` to only create
+        variations containing this option; ``start`` and ``stop`` then refer
+        to positions among those combinations. Returns the number of
+        variations created.
+
+        Does nothing for products with ``sparse_variations``.
+        """
+        if self.sparse_variations:
+            return 0
+
+        space = combinations = self.combination_space()
+        option_ids = space.option_ids
+        if option is not None:
+            if getattr(option, 'pk', option) not in option_ids:
+                return 0
+            combinations = space.fix(option)
+        start, stop, step = slice(start, stop).indices(len(combinations))
+
+        signatures = {}
+        orderings = {}
+        skus = set()
+        for variation_id, ordering, signature, sku in self.variations.order_by(
+                'ordering', 'id').values_list('id', 'ordering', 'options_signature', 'sku'):
+            skus.add(sku)
+            signature = frozenset(option_ids.intersection(
+                parse_options_signature(signature)))
+            if signature in signatures:
+                continue
+            signatures[signature] = variation_id
+
+            if not space.is_valid(signature):
+                continue
+            idx = space.index_of(signature)
+            if (option is not None or start <= idx < stop) and ordering != idx:
+                orderings[variation_id] = idx
+
+        missing = {}
+        generated = {}
+        for variation in combinations.iterate(start, stop):
+            if frozenset(o.pk for o in variation) not in signatures:
+                sku = self._variation_sku(variation)
+                generated[sku] = generated.get(sku, 0) + 1
+                missing[options_signature(o.pk for o in variation)] = (
+                    space.index_of(variation), variation, sku)
+
+        if missing:
+            # Option values do not have to be unique; disambiguate the SKUs
+            # of combinations whose values are the same
+            bulk_insert(ProductVariation, [ProductVariation(
+                product=self,
+                is_active=self.is_active,
+                sku=(generated[sku] > 1 or sku in skus) and u'%s-%s' % (sku, idx) or sku,
+                ordering=idx,
+                options_name_cache=options_name(variation),
+                options_signature=signature,
+                ) for signature, (idx, variation, sku) in missing.items()])
+
+            field = ProductVariation._meta.get_field('options')
+            through = field.rel.through
+            source = '%s_id' % field.m2m_field_name()
+            target = '%s_id' % field.m2m_reverse_field_name()
+
+            rows = []
+            for chunk in chunked(missing.keys(), 500):
+                for signature, variation_id in self.variations.filter(
+                        options_signature__in=chunk).order_by().values_list(
+                        'options_signature', 'id'):
+                    rows.extend(through(**{source: variation_id, target: o.pk})
+                        for o in missing[signature][1])
+            bulk_insert(through, rows)
+            self.flush_stock_cache()
+
+        bulk_update(ProductVariation, 'ordering', orderings)
+        return len(missing)
+
+    def _variation_sku(self, options):
+        parts = [self.sku]
+        parts.extend(o.value for o in options)
+        return u'-'.join(parts)
+
+    def combination_space(self):
+        """
+        Returns the ``CombinationSpace`` of all combinations of options of
+        this product
+        """
+        return CombinationSpace.for_product(self)
+
+    def variation_for_options(self, options, create=None):
+        """
+        Returns the variation with exactly the given options
 
-        for idx, variation in enumerate(variations):
+        Missing variations of products with ``sparse_variations`` are created
+        if the options are a valid combination (pass ``create=False`` to
+        prevent this). Raises ``ProductVariation.DoesNotExist`` otherwise.
+        """
+        options = list(options)
+        signature = options_signature(o.pk for o in options)
+        try:
+            variation = self._variation_for_signature(signature)
+            # Spare the query when the variation is priced
+            variation.product = self
+            return variation
+        except ProductVariation.DoesNotExist:
+            if create is None:
+                create = self.sparse_variations
+            space = create and self.combination_space()
+            if not (space and space.is_valid(options)):
+                raise
+
+            # Use the position of the combination and the order of groups
+            idx = space.index_of(options)
+            options = space.combination_at(idx)
+
+        # Disambiguate the SKU like create_variations if it is taken already
+        sku = self._variation_sku(options)
+        for candidate in (sku, u'%s-%s' % (sku, idx)):
+            sid = transaction.savepoint()
             try:
-                qset = self.variations
-                for o in variation:
-                    qset = qset.filter(options=o)
-
-                instance = qset.get()
-            except ProductVariation.DoesNotExist:
-                parts = [self.sku]
-                parts.extend(o.value for o in variation)
-                instance = self.variations.create(
+                variation = self.variations.create(
                     is_active=self.is_active,
-                    sku=u'-'.join(parts),
+                    sku=candidate,
+                    ordering=idx,
+                    options_name_cache=options_name(options),
+                    options_signature=signature,
                     )
-                instance.options = variation
+                variation.options.add(*options)
+            except IntegrityError, e:
+                transaction.savepoint_rollback(sid)
+                try:
+                    # Somebody else was faster
+                    return self._variation_for_signature(signature)
+                except ProductVariation.DoesNotExist:
+                    error = e
+            else:
+                transaction.savepoint_commit(sid)
+                return variation
+
+        raise error
+
+    def _variation_for_signature(self, signature):
+        # Variations retired by retire_option_variations have no signature
+        # either; prefer active variations for products without options
+        try:
+            return self.variations.filter(options_signature=signature).order_by(
+                '-is_active', 'ordering', 'id')[:1][0]
+        except IndexError:
+            raise ProductVariation.DoesNotExist
+
+    def option_schema_key(self):
+        """
+        Returns the versioned cache key of the option schema, which changes
+        whenever the option groups of the product or their options change
+        """
+        all_key = option_generation_key('all')
+        product_key = option_generation_key('product-%s' % self.pk)
+        generations = option_cache.generations([all_key, product_key])
+        return 'product-options-%s@%s.%s' % (self.pk, generations[all_key],
+            generations[product_key])
+
+    def option_schema(self):
+        """
+        Returns the option groups of the product and their options as a list
+        of ``(group_id, group_name, [(option_id, option_name), ...])`` tuples
+
+        The schema is cached; building it takes two queries.
+        """
+        def compute():
+            groups = [(group.pk, unicode(group), [])
+                for group in self.option_groups.all()]
+            options = dict((group_id, choices) for group_id, name, choices in groups)
+            for option in Option.objects.filter(group__in=options.keys()):
+                options[option.group_id].append((option.pk, unicode(option)))
+            return groups, OPTION_CACHE_TIMEOUT
 
-            instance.ordering = idx
-            instance.save()
+        return option_cache.get_or_compute(self.option_schema_key(), compute)
+
+    def stock_matrix_json(self):
+        """
+        Returns the stock matrix (see ``stock_matrix``) as JSON
+
+        The JSON blob is cached until the stock of a variation changes, and
+        can be embedded in product detail pages as it is.
+        """
+        def compute():
+            return simplejson.dumps(self._build_stock_matrix()), STOCK_CACHE_TIMEOUT
+
+        return stock_cache.get_or_compute(self._stock_cache_key('stock'), compute)
+
+    def _stock_cache_key(self, name):
+        generation_key = stock_generation_key(self.pk)
+        return 'product-%s-%s@%s' % (name, self.pk,
+            stock_cache.generations([generation_key])[generation_key])
+
+    def stock_matrix(self):
+        """
+        Returns a dictionary mapping the option keys of all active variations
+        to the number of items available, that is ``items_in_stock`` minus
+        ``items_reserved``. Keys list the option primary keys in the default
+        ordering of options, joined by underscores.
+        """
+        return simplejson.loads(self.stock_matrix_json())
+
+    def _build_stock_matrix(self):
+        # A single query returns one row per option of every variation
+        options = {}
+        stock = {}
+        for variation_id, items_in_stock, items_reserved, option_id in self.variations.filter(
+                is_active=True).order_by('id', 'options__group', 'options__ordering',
+                'options__id').values_list('id', 'items_in_stock', 'items_reserved',
+                'options__id'):
+            stock[variation_id] = max(items_in_stock - items_reserved, 0)
+            if option_id is not None:
+                options.setdefault(variation_id, []).append(str(option_id))
+
+        return dict(('_'.join(options.get(variation_id, ())), items_in_stock)
+            for variation_id, items_in_stock in stock.items())
 
     def items_in_stock(self):
-        items = {}
+        return self.stock_matrix()
 
-        for variation in self.variations.filter(is_active=True):
-            key = '_'.join(str(pk) for pk in variation.options.values_list('pk', flat=True))
-            items[key] = variation.items_in_stock
+    def option_availability(self):
+        """
+        Returns the ``AvailabilityIndex`` of the active variations, which is
+        cached until the stock of a variation changes
+        """
+        def compute():
+            return AvailabilityIndex.for_product(self).describe(), STOCK_CACHE_TIMEOUT
 
-        return items
+        return AvailabilityIndex.from_description(stock_cache.get_or_compute(
+            self._stock_cache_key('availability'), compute))
 
 
 class ProductVariation(models.Model):
@@ -286,14 +917,22 @@ class ProductVariation(models.Model):
     is_active = models.BooleanField(_('is active'), default=True)
     sku = models.CharField(_('SKU'), max_length=100, unique=True)
     items_in_stock = models.IntegerField(_('items in stock'), default=0)
+    items_reserved = models.IntegerField(_('items reserved'), default=0,
+        editable=False,
+        help_text=_('Items reserved for carts, kept up to date automatically.'))
     options = models.ManyToManyField(Option, related_name='variations',
         blank=True, null=True, verbose_name=_('options'))
     options_name_cache = models.CharField(_('options name cache'), max_length=100,
         blank=True, editable=False)
-    ordering = models.PositiveIntegerField(_('ordering'), default=0)
+    options_signature = models.CharField(_('options signature'), max_length=255,
+        blank=True, null=True, editable=False,
+        help_text=_('Sorted primary keys of all options, kept up to date automatically.'))
+    # Positions of combinations in large spaces exceed 32 bits
+    ordering = models.BigIntegerField(_('ordering'), default=0)
 
     class Meta:
         ordering = ['ordering', 'product']
+        unique_together = (('product', 'options_signature'),)
         verbose_name = _('product variation')
         verbose_name_plural = _('product variations')
 
@@ -306,7 +945,7 @@ class ProductVariation(models.Model):
         if options is None:
             options = self.options.all()
 
-        self.options_name_cache = u', '.join(unicode(o) for o in options)
+        self.options_name_cache = options_name(options)
 
     def can_delete(self):
         return self.orderitem_set.count() == 0
@@ -330,6 +969,598 @@ class ProductVariation(models.Model):
     get_price = _generate_proxy('get_price')
 
 
+def options_signature(option_ids):
+    """
+    Returns the canonical signature of a combination of options: Their sorted
+    primary keys joined by underscores, or ``None`` for no options at all
+    """
+    return u'_'.join(str(pk) for pk in sorted(set(option_ids))) or None
+
+
+def options_name(options):
+    """
+    Returns the value of ``options_name_cache`` for the given options
+    """
+    max_length = ProductVariation._meta.get_field('options_name_cache').max_length
+    return u', '.join(unicode(o) for o in options)[:max_length]
+
+
+def regenerate_options_name_cache(option_ids):
+    """
+    Rebuilds ``options_name_cache`` of all variations containing one of the
+    given options with two queries plus one ``UPDATE`` per 250 variations
+    """
+    through = ProductVariation.options.through
+    variation_ids = set(through.objects.filter(option__in=list(option_ids)).values_list(
+        'productvariation', flat=True))
+
+    for chunk in chunked(variation_ids, 500):
+        names = dict((pk, []) for pk in chunk)
+        for variation_id, name in through.objects.filter(
+                productvariation__in=chunk).order_by(
+                'option__group__id', 'option__ordering').values_list(
+                'productvariation', 'option__name'):
+            names[variation_id].append(name)
+
+        bulk_update(ProductVariation, 'options_name_cache', dict(
+            (pk, options_name(option_names)) for pk, option_names in names.items()))
+
+
+def parse_options_signature(signature):
+    if not signature:
+        return []
+    return [int(pk) for pk in signature.split('_')]
+
+
+def sync_options_signatures(variation_ids=None):
+    """
+    Recomputes ``options_signature`` of the given variations, or of all
+    variations if ``variation_ids`` is ``None``
+    """
+    through = ProductVariation.options.through
+    variations = ProductVariation.objects.order_by()
+    if variation_ids is not None:
+        variations = variations.filter(pk__in=variation_ids)
+
+    for chunk in chunked(variations.values_list('id', flat=True).iterator(), 500):
+        options = dict((pk, []) for pk in chunk)
+        for variation_id, option_id in through.objects.filter(
+                productvariation__in=chunk).values_list('productvariation', 'option'):
+            options[variation_id].append(option_id)
+
+        bulk_update(ProductVariation, 'options_signature', dict(
+            (pk, options_signature(option_ids)) for pk, option_ids in options.items()))
+
+
+def update_options_signature(instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # Remember which variations lose the option
+        instance._cleared_variations = list(
+            instance.variations.values_list('id', flat=True))
+        return
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        instance.options_signature = options_signature(
+            instance.options.values_list('id', flat=True))
+        ProductVariation.objects.filter(pk=instance.pk).update(
+            options_signature=instance.options_signature)
+    elif action == 'post_clear':
+        sync_options_signatures(getattr(instance, '_cleared_variations', ()))
+    else:
+        sync_options_signatures(pk_set)
+
+signals.m2m_changed.connect(update_options_signature,
+    sender=ProductVariation.options.through)
+
+
+def flush_variation_stock_cache(instance, **kwargs):
+    invalidate_product_stock([instance.product_id])
+
+signals.post_save.connect(flush_variation_stock_cache, sender=ProductVariation)
+signals.post_delete.connect(flush_variation_stock_cache, sender=ProductVariation)
+
+
+def flush_variation_options_stock_cache(instance, action, reverse, pk_set, **kwargs):
+    # The options of variations determine the keys of the stock matrix
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        invalidate_product_stock([instance.product_id])
+        return
+
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_variations', ())
+    if pk_set:
+        invalidate_product_stock(set(ProductVariation.objects.filter(
+            pk__in=pk_set).values_list('product', flat=True)))
+
+signals.m2m_changed.connect(flush_variation_options_stock_cache,
+    sender=ProductVariation.options.through)
+
+
+if 'plata.product.stock' in settings.INSTALLED_APPS:
+    from plata.product.stock.models import StockTransaction
+
+    def flush_stock_transaction_stock_cache(instance, **kwargs):
+        # Stock transactions update items_in_stock without sending signals
+        invalidate_product_stock(set(ProductVariation.objects.filter(
+            pk=instance.product_id).values_list('product', flat=True)))
+
+    signals.post_save.connect(flush_stock_transaction_stock_cache,
+        sender=StockTransaction)
+    signals.post_delete.connect(flush_stock_transaction_stock_cache,
+        sender=StockTransaction)
+
+
+def recount_items_in_stock(variation_ids):
+    """
+    Recomputes the ``items_in_stock`` fields of the given variations with
+    one aggregate query and one ``UPDATE`` per batch, using the stock
+    snapshots if ``options_product.snapshots`` is installed, and returns a
+    dictionary mapping the primary keys to the new values. The stock cache
+    is not invalidated.
+
+    The fields are kept up to date when stock transactions are saved, but
+    still include payment process reservations which have expired since.
+    """
+    variation_ids = list(variation_ids)
+    if not variation_ids:
+        return {}
+
+    if 'options_product.snapshots' in settings.INSTALLED_APPS:
+        from options_product.snapshots.models import StockSnapshot
+        counts = StockSnapshot.objects.items_in_stock_bulk(variation_ids)
+    else:
+        from plata.product.stock.models import StockTransaction
+        counts = dict.fromkeys(variation_ids, 0)
+        for chunk in chunked(variation_ids, 500):
+            for row in StockTransaction.objects.stock().filter(
+                    product__in=chunk).order_by().values('product').annotate(
+                    items=Sum('change')):
+                counts[row['product']] = row['items']
+
+    bulk_update(ProductVariation, 'items_in_stock', counts)
+    return counts
+
+
+def stock_held_by_order(order, variation_ids=None):
+    """
+    Returns a dictionary mapping variation primary keys to the number of
+    items the unexpired stock transactions of the order, f.e. payment
+    process reservations, have taken from ``items_in_stock``
+    """
+    if 'plata.product.stock' not in settings.INSTALLED_APPS:
+        return {}
+
+    from plata.product.stock.models import StockTransaction
+
+    queryset = StockTransaction.objects.stock().filter(order=order)
+    if variation_ids is not None:
+        queryset = queryset.filter(product__in=variation_ids)
+    return dict((row['product'], -row['total']) for row in
+        queryset.order_by().values('product').annotate(total=Sum('change')))
+
+
+class VariationSyncJobManager(models.Manager):
+    def pending(self):
+        return self.filter(status__in=(self.model.PENDING, self.model.RUNNING))
+
+
+class VariationSyncJob(models.Model):
+    """
+    Creates the variations which are missing after an option has been added
+    to an option group, or after the option groups of a product have
+    changed
+
+    Option groups may be shared by thousands of products, therefore jobs are
+    processed in batches of products outside of the request/response cycle,
+    f.e. by the ``sync_variations`` management command. Jobs remember the
+    last product processed and can be resumed after interruptions.
+    """
+
+    PENDING = 10
+    RUNNING = 20
+    DONE = 30
+    FAILED = 40
+
+    STATUS_CHOICES = (
+        (PENDING, _('pending')),
+        (RUNNING, _('running')),
+        (DONE, _('done')),
+        (FAILED, _('failed')),
+        )
+
+    created = models.DateTimeField(_('created'), default=datetime.now)
+    status = models.PositiveIntegerField(_('status'), choices=STATUS_CHOICES,
+        default=PENDING)
+    option = models.ForeignKey(Option, blank=True, null=True,
+        related_name='variation_sync_jobs', verbose_name=_('option'),
+        help_text=_('Create the variations containing this option for all products using its group.'))
+    product = models.ForeignKey(Product, blank=True, null=True,
+        related_name='variation_sync_jobs', verbose_name=_('product'),
+        help_text=_('Create all missing variations of this product.'))
+
+    products_total = models.PositiveIntegerField(_('products total'), default=0)
+    products_done = models.PositiveIntegerField(_('products done'), default=0)
+    variations_created = models.PositiveIntegerField(_('variations created'), default=0)
+    last_product_id = models.PositiveIntegerField(_('last product ID'), default=0)
+    error = models.TextField(_('error'), blank=True)
+
+    class Meta:
+        ordering = ['created', 'id']
+        verbose_name = _('variation sync job')
+        verbose_name_plural = _('variation sync jobs')
+
+    objects = VariationSyncJobManager()
+
+    def __unicode__(self):
+        if self.option_id:
+            return u'%s: %s' % (self.option.full_name(), self.progress())
+        return u'%s: %s' % (self.product, self.progress())
+
+    def products(self):
+        """
+        Returns all products this job has to process
+        """
+        products = Product.objects.filter(sparse_variations=False)
+        if self.option_id:
+            return products.filter(option_groups=self.option.group_id)
+        return products.filter(pk=self.product_id)
+
+    def progress(self):
+        return u'%s/%s' % (self.products_done, self.products_total)
+
+    def process(self, batch_size=100):
+        """
+        Processes the next ``batch_size`` products and saves the progress.
+        Returns ``True`` if the job is done.
+
+        Call this inside a transaction so that the progress is only saved
+        together with the variations, and use ``fail`` to record errors
+        after the transaction has been rolled back.
+        """
+        if self.status == self.PENDING:
+            self.products_total = self.products().count()
+
+        self.status = self.RUNNING
+        products = list(self.products().filter(
+            pk__gt=self.last_product_id).order_by('pk')[:batch_size])
+
+        for product in products:
+            self.variations_created += product.create_variations(
+                option=self.option)
+            self.last_product_id = product.pk
+            self.products_done += 1
+
+        if len(products) < batch_size:
+            self.status = self.DONE
+        self.save()
+        return self.status == self.DONE
+
+    def fail(self, error):
+        """
+        Marks the job as failed without touching the saved progress
+        """
+        self.status = self.FAILED
+        self.error = unicode(error)
+        VariationSyncJob.objects.filter(pk=self.pk).update(
+            status=self.status, error=self.error)
+
+
+def create_option_sync_job(instance, created, raw=False, **kwargs):
+    if created and not raw:
+        VariationSyncJob.objects.create(option=instance)
+
+signals.post_save.connect(create_option_sync_job, sender=Option)
+
+
+def create_product_sync_jobs(instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # Remember which products lose the option group
+        instance._cleared_products = list(
+            instance.products.values_list('id', flat=True))
+        return
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        pk_set = [instance.pk]
+    elif action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_products', ())
+
+    for pk in pk_set or ():
+        # Assigning option groups sends post_clear and post_add
+        if not VariationSyncJob.objects.filter(product=pk,
+                status=VariationSyncJob.PENDING).exists():
+            VariationSyncJob.objects.create(product_id=pk)
+
+signals.m2m_changed.connect(create_product_sync_jobs,
+    sender=Product.option_groups.through)
+
+
+def flush_product_option_cache(instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if reverse:
+        if action == 'post_clear':
+            invalidate_option_cache()
+        else:
+            invalidate_product_options(pk_set)
+    else:
+        invalidate_product_options([instance.pk])
+
+signals.m2m_changed.connect(flush_product_option_cache,
+    sender=Product.option_groups.through)
+
+
+def retire_option_variations(instance, **kwargs):
+    """
+    Deactivates all variations containing an option which is being deleted
+    with a single ``UPDATE``. Their signatures are reset because they do not
+    describe a valid combination of options anymore.
+    """
+    variations = ProductVariation.objects.filter(options=instance)
+    invalidate_product_stock(set(variations.values_list('product', flat=True)))
+    variations.update(is_active=False, options_signature=None)
+
+signals.pre_delete.connect(retire_option_variations, sender=Option)
+
+
+def update_options_name_cache(instance, created, raw=False, **kwargs):
+    # Names and orderings of options are part of the cached names
+    if not (created or raw):
+        regenerate_options_name_cache([instance.pk])
+
+signals.post_save.connect(update_options_name_cache, sender=Option)
+
+signals.post_save.connect(invalidate_option_cache, sender=OptionGroup)
+signals.post_delete.connect(invalidate_option_cache, sender=OptionGroup)
+signals.post_save.connect(invalidate_option_cache, sender=Option)
+signals.post_delete.connect(invalidate_option_cache, sender=Option)
+
+
+#: Number of seconds items stay reserved for a cart after they have been
+#: added to it
+RESERVATION_TIMEOUT = getattr(settings, 'OPTIONS_PRODUCT_RESERVATION_TIMEOUT',
+    30 * 60)
+
+
+class StockReservationManager(models.Manager):
+    def expired(self, now=None):
+        return self.filter(expires__lt=now or datetime.now())
+
+    def reserve(self, variation, order, quantity):
+        """
+        Reserves ``quantity`` items of the variation for the order, replacing
+        an earlier reservation of the same order. Returns ``False`` without
+        reserving anything if not enough items are available.
+
+        The ``items_reserved`` counter of the variation is only increased if
+        it does not exceed ``items_in_stock`` afterwards, using a single
+        conditional ``UPDATE``. The database serializes updates of the same
+        row, therefore concurrent buyers cannot reserve more items than there
+        are in stock. If the ``UPDATE`` fails, ``items_in_stock`` is
+        recomputed and the items taken by stock transactions of the order
+        itself are added back before trying once more. Call this inside a
+        transaction.
+        """
+        variation_id = getattr(variation, 'pk', variation)
+        order_id = getattr(order, 'pk', order)
+        quantity = max(quantity, 0)
+        expires = datetime.now() + timedelta(seconds=RESERVATION_TIMEOUT)
+
+        while True:
+            try:
+                reservation = self.get(variation=variation_id, order=order_id)
+                reserved = reservation.quantity
+            except self.model.DoesNotExist:
+                reservation, reserved = None, 0
+
+            change = quantity - reserved
+            if change:
+                if not self._increase_reserved(variation_id, order_id, change):
+                    return False
+                invalidate_variation_stock(variation)
+
+            if reservation is None:
+                if not quantity:
+                    return True
+
+                sid = transaction.savepoint()
+                try:
+                    self.create(variation_id=variation_id, order_id=order_id,
+                        quantity=quantity, expires=expires)
+                    transaction.savepoint_commit(sid)
+                    return True
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+            elif not quantity:
+                if bulk_delete(self.model, [reservation.pk]):
+                    return True
+            elif self.filter(pk=reservation.pk, quantity=reserved).update(
+                    quantity=quantity, expires=expires):
+                return True
+
+            # Another request of the same order changed the reservation in
+            # the meantime. Undo the change of the counter and start over.
+            if change:
+                ProductVariation.objects.filter(pk=variation_id).update(
+                    items_reserved=models.F('items_reserved') - change)
+
+    def _increase_reserved(self, variation_id, order_id, change):
+        counter = ProductVariation.objects.filter(pk=variation_id)
+        update = dict(items_reserved=models.F('items_reserved') + change)
+        if change < 0:
+            return counter.update(**update)
+
+        if counter.filter(items_in_stock__gte=models.F('items_reserved') + change
+                ).update(**update):
+            return True
+
+        if 'plata.product.stock' not in settings.INSTALLED_APPS:
+            return False
+
+        # items_in_stock may still include expired payment process
+        # reservations, and it includes the transactions of this order
+        recount_items_in_stock([variation_id])
+        invalidate_variation_stock(variation_id)
+        held = stock_held_by_order(order_id, [variation_id]).get(variation_id, 0)
+        return counter.filter(
+            items_in_stock__gte=models.F('items_reserved') + (change - held)
+            ).update(**update)
+
+    def available(self, variation, order=None):
+        """
+        Returns the number of items of the variation which may be reserved
+        for the order, from the counters of the variation
+        """
+        variation_id = getattr(variation, 'pk', variation)
+        in_stock, reserved = ProductVariation.objects.filter(
+            pk=variation_id).values_list('items_in_stock', 'items_reserved')[0]
+        if order is not None:
+            order_id = getattr(order, 'pk', order)
+            reserved -= sum(self.filter(variation=variation_id,
+                order=order_id).values_list('quantity', flat=True))
+            in_stock += stock_held_by_order(order_id, [variation_id]).get(
+                variation_id, 0)
+        return max(in_stock - reserved, 0)
+
+    def release(self, reservations=None, batch_size=500):
+        """
+        Deletes the given reservations (all expired reservations by default)
+        and returns their items to the counters of the variations, with one
+        ``DELETE`` and one ``UPDATE`` per batch. Returns the number of
+        reservations released.
+        """
+        if reservations is None:
+            reservations = self.expired()
+
+        released = 0
+        for chunk in chunked(reservations.order_by().values_list(
+                'id', 'variation', 'variation__product', 'quantity'), batch_size):
+            released += self._release(chunk)
+        return released
+
+    def sweep(self, now=None, batch_size=500):
+        """
+        Releases all reservations expired at ``now``, yielding the number of
+        reservations released per batch. The expired reservations are
+        determined with a single query, and every batch is committed
+        separately so that the variation rows are not locked for longer
+        than necessary.
+        """
+        rows = list(self.expired(now).order_by('variation').values_list(
+            'id', 'variation', 'variation__product', 'quantity'))
+
+        release = transaction.commit_on_success(self._release)
+        for chunk in chunked(rows, batch_size):
+            yield release(chunk)
+
+    def _release(self, rows):
+        changes = {}
+        for pk, variation_id, product_id, quantity in rows:
+            changes[variation_id] = changes.get(variation_id, 0) - quantity
+
+        deleted = bulk_delete(self.model, [row[0] for row in rows])
+        if deleted == len(rows):
+            bulk_increment(ProductVariation, 'items_reserved', changes)
+        else:
+            # Some of the reservations have been released concurrently
+            self.recount(changes.keys())
+
+        invalidate_product_stock(set(row[2] for row in rows))
+        return deleted
+
+    def recount(self, variation_ids):
+        """
+        Recomputes the ``items_reserved`` counters of the given variations
+        from the reservations
+        """
+        qn = connection.ops.quote_name
+        table = qn(ProductVariation._meta.db_table)
+        pk = qn(ProductVariation._meta.pk.column)
+
+        cursor = connection.cursor()
+        for chunk in chunked(variation_ids, 500):
+            cursor.execute(u'UPDATE %s SET %s = (SELECT COALESCE(SUM(%s), 0) FROM %s'
+                u' WHERE %s.%s = %s.%s) WHERE %s IN (%s)' % (
+                    table,
+                    qn(ProductVariation._meta.get_field('items_reserved').column),
+                    qn(self.model._meta.get_field('quantity').column),
+                    qn(self.model._meta.db_table),
+                    qn(self.model._meta.db_table),
+                    qn(self.model._meta.get_field('variation').column),
+                    table,
+                    pk,
+                    pk,
+                    u', '.join([u'%s'] * len(chunk)),
+                    ), chunk)
+        transaction.set_dirty()
+
+
+class StockReservation(models.Model):
+    """
+    Items of a variation held for a cart
+
+    Reservations are made when items are added to a cart and released when
+    the order item is removed, when stock transactions of the order are
+    created (at the latest when the order is confirmed) or after
+    ``RESERVATION_TIMEOUT`` seconds. The sum of all reservations of a
+    variation is kept in its ``items_reserved`` field, so that the number of
+    available items can be determined without aggregating stock transactions.
+    """
+
+    variation = models.ForeignKey(ProductVariation, related_name='reservations',
+        verbose_name=_('product variation'))
+    order = models.ForeignKey(Order, related_name='stock_reservations',
+        verbose_name=_('order'))
+    quantity = models.PositiveIntegerField(_('quantity'))
+    expires = models.DateTimeField(_('expires'), db_index=True)
+
+    class Meta:
+        unique_together = (('variation', 'order'),)
+        verbose_name = _('stock reservation')
+        verbose_name_plural = _('stock reservations')
+
+    objects = StockReservationManager()
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.variation, self.quantity)
+
+
+def release_deleted_reservation(instance, **kwargs):
+    # Reservations deleted through the ORM, f.e. together with their order
+    ProductVariation.objects.filter(pk=instance.variation_id).update(
+        items_reserved=models.F('items_reserved') - instance.quantity)
+    invalidate_variation_stock(instance.variation_id)
+
+signals.post_delete.connect(release_deleted_reservation, sender=StockReservation)
+
+
+def release_order_item_reservation(instance, **kwargs):
+    StockReservation.objects.release(StockReservation.objects.filter(
+        order=instance.order_id, variation=instance.product_id))
+
+signals.post_delete.connect(release_order_item_reservation, sender=OrderItem)
+
+
+if 'plata.product.stock' in settings.INSTALLED_APPS:
+    def release_stock_transaction_reservation(instance, created, **kwargs):
+        # Stock transactions of orders replace their reservations
+        if created and instance.order_id and instance.change < 0:
+            StockReservation.objects.release(StockReservation.objects.filter(
+                order=instance.order_id, variation=instance.product_id))
+
+    signals.post_save.connect(release_stock_transaction_reservation,
+        sender=StockTransaction)
+
+
 class PriceManager(models.Manager):
     def active(self):
         return self.filter(
@@ -337,6 +1568,14 @@ class PriceManager(models.Manager):
             Q(valid_from__lte=date.today()),
             Q(valid_until__isnull=True) | Q(valid_until__gte=date.today()))
 
+    def current(self):
+        """
+        Returns active prices and prices which will become active later
+        """
+        return self.filter(
+            Q(is_active=True),
+            Q(valid_until__isnull=True) | Q(valid_until__gte=date.today()))
+
 
 class ProductPrice(PriceBase):
     product = models.ForeignKey(Product, verbose_name=_('product'),
@@ -348,6 +1587,8 @@ class ProductPrice(PriceBase):
 
     is_sale = models.BooleanField(_('is sale'), default=False,
         help_text=_('Set this if this price is a sale price. Whether the sale is temporary or not does not matter.'))
+    min_quantity = models.PositiveIntegerField(_('minimum quantity'), default=1,
+        help_text=_('Set this to create a quantity tier: The price applies if at least this many items are ordered and it is lower than the normal or sale price.'))
 
     class Meta:
         ordering = ['-valid_from']
@@ -364,17 +1605,129 @@ class ProductPrice(PriceBase):
         item.is_sale = self.is_sale
 
 
+class CachedPrice(object):
+    """
+    Compact, picklable stand-in for ``ProductPrice`` instances which is
+    stored in the price cache instead of full model instances
+
+    Offers the values and properties needed to determine prices. Everything
+    else, including ``handle_order_item``, is delegated to the full
+    ``ProductPrice`` instance, which is only fetched from the database
+    when it is actually needed.
+    """
+
+    __slots__ = ('pk', 'product_id', 'currency', '_unit_price', 'tax_included',
+        'tax_class_id', 'tax_rate', 'is_sale', 'valid_from', 'valid_until',
+        'min_quantity', '_instance')
+
+    def __init__(self, pk, product_id, currency, _unit_price, tax_included,
+            tax_class_id, tax_rate, is_sale, valid_from, valid_until,
+            min_quantity=1):
+        self.__setstate__((pk, product_id, currency, _unit_price, tax_included,
+            tax_class_id, tax_rate, is_sale, valid_from, valid_until, min_quantity))
+
+    @classmethod
+    def from_price(cls, price):
+        return cls(price.pk, price.product_id, price.currency, price._unit_price,
+            price.tax_included, price.tax_class_id, price.tax_class.rate,
+            price.is_sale, price.valid_from, price.valid_until, price.min_quantity)
+
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__[:-1])
+
+    def __setstate__(self, state):
+        for attr, value in zip(self.__slots__[:-1], state):
+            object.__setattr__(self, attr, value)
+        object.__setattr__(self, '_instance', None)
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            # Do not fetch the instance when pickle & co. look for hooks
+            raise AttributeError(attr)
+        return getattr(self.instance, attr)
+
+    def __setattr__(self, attr, value):
+        if attr in self.__slots__:
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self.instance, attr, value)
+
+    def __eq__(self, other):
+        return isinstance(other, (CachedPrice, ProductPrice)) and self.pk == other.pk
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __repr__(self):
+        return '<CachedPrice: %s>' % self
+
+    def __unicode__(self):
+        return u'%s %.2f' % (self.currency, self.unit_price)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    @property
+    def id(self):
+        return self.pk
+
+    @property
+    def instance(self):
+        """
+        The full ``ProductPrice`` instance
+        """
+        if self._instance is None:
+            self._instance = ProductPrice.objects.select_related('tax_class').get(
+                pk=self.pk)
+        return self._instance
+
+    def handle_order_item(self, item):
+        self.instance.handle_order_item(item)
+
+    # The following properties are the same as in plata.shop.models.PriceBase
+
+    @property
+    def unit_tax(self):
+        return self.unit_price_excl_tax * (self.tax_rate/100)
+
+    @property
+    def unit_price_incl_tax(self):
+        if self.tax_included:
+            return self._unit_price
+        return self._unit_price * (1+self.tax_rate/100)
+
+    @property
+    def unit_price_excl_tax(self):
+        if not self.tax_included:
+            return self._unit_price
+        return self._unit_price / (1+self.tax_rate/100)
+
+    @property
+    def unit_price(self):
+        if plata.settings.PLATA_PRICE_INCLUDES_TAX:
+            return self.unit_price_incl_tax
+        else:
+            return self.unit_price_excl_tax
+
+
 def flush_price_cache(instance, **kwargs):
-    try:
-        instance.product.flush_price_cache()
-    except models.ObjectDoesNotExist:
-        # The product has been deleted already
-        pass
+    invalidate_product_prices([instance.product_id])
 
 signals.post_save.connect(flush_price_cache, sender=ProductPrice)
 signals.post_delete.connect(flush_price_cache, sender=ProductPrice)
 
 
+def invalidate_price_cache_for_tax_class(instance, **kwargs):
+    # Cached prices contain tax rates
+    invalidate_price_cache()
+
+signals.post_save.connect(invalidate_price_cache_for_tax_class, sender=TaxClass)
+signals.post_delete.connect(invalidate_price_cache_for_tax_class, sender=TaxClass)
+
+
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, verbose_name=_('product'),
         related_name='images')
@@ -0,0 +1,249 @@
+"""
+Bulk import of product prices
+
+Price files are processed as a stream of rows in batches. Every batch
+costs one query to resolve SKUs, a few set-based ``UPDATE`` statements to
+retire superseded prices and one multi-row ``INSERT``. Afterwards, the
+imported prices are read once more to let them supersede each other. No
+model signals are sent; the cached prices of all affected products are
+invalidated at once after the import has been committed.
+
+Rows are dictionaries with the following keys:
+
+- ``sku``: SKU of the product (required)
+- ``currency``: Currency code (required)
+- ``unit_price``: Unit price (required)
+- ``tax_class``: Primary key or name of the tax class (required)
+- ``tax_included``: Whether the unit price includes tax (defaults to
+  ``PLATA_PRICE_INCLUDES_TAX``)
+- ``is_sale``: Whether this is a sale price (defaults to ``False``)
+- ``valid_from``: First day of validity, ``YYYY-MM-DD`` (defaults to today)
+- ``valid_until``: Last day of validity (optional)
+- ``min_quantity``: Minimum quantity of a quantity tier (defaults to 1)
+
+A price supersedes the active prices of the same product, currency, type
+(normal or sale price) and minimum quantity: Prices starting the same day are deactivated,
+older prices are ended the day before the new price becomes valid. This
+also applies to prices of the same import, independent of their order and
+of the batches they end up in; of several imported prices starting the
+same day, the last one wins.
+"""
+
+import csv
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import simplejson
+
+import plata
+from plata.shop.models import TaxClass
+
+from options_product.caching import deferred_invalidation
+from options_product.models import Product, ProductPrice, invalidate_product_prices
+from options_product.utils import bulk_insert, bulk_update, chunked
+
+
+class PriceImportError(ValueError):
+    pass
+
+
+def read_csv(fileobj):
+    """
+    Yields rows of a CSV file with a header line
+    """
+    reader = csv.DictReader(fileobj)
+    for row in reader:
+        if None in row:
+            # DictReader collects surplus values in a list stored as None
+            raise PriceImportError(u'Line %s has more columns than the header' %
+                reader.line_num)
+        yield dict((key, value.decode('utf-8')) for key, value in row.items()
+            if value is not None)
+
+
+def read_jsonl(fileobj):
+    """
+    Yields rows of a JSON Lines file, that is, one JSON object per line
+    """
+    for line in fileobj:
+        line = line.strip()
+        if line:
+            yield simplejson.loads(line)
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+    }
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return unicode(value).strip().lower() in (u'1', u'true', u'yes', u'y')
+
+
+def _parse_date(value):
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(unicode(value).strip(), '%Y-%m-%d').date()
+
+
+class PriceRowParser(object):
+    """
+    Converts rows into unsaved ``ProductPrice`` instances
+    """
+
+    def __init__(self):
+        self.today = date.today()
+        self.tax_classes = {}
+        for tax_class in TaxClass.objects.all():
+            self.tax_classes[unicode(tax_class.pk)] = tax_class.pk
+            self.tax_classes[tax_class.name] = tax_class.pk
+
+    def __call__(self, row, product_id):
+        try:
+            currency = row['currency'].strip().upper()
+            if currency not in plata.settings.CURRENCIES:
+                raise ValueError('Unknown currency %r' % currency)
+
+            tax_class = unicode(row['tax_class']).strip()
+            if tax_class not in self.tax_classes:
+                raise ValueError('Unknown tax class %r' % tax_class)
+
+            tax_included = row.get('tax_included', u'')
+            valid_from = row.get('valid_from', u'')
+            valid_until = row.get('valid_until', u'')
+            min_quantity = row.get('min_quantity', u'')
+
+            return ProductPrice(
+                product_id=product_id,
+                currency=currency,
+                _unit_price=Decimal(unicode(row['unit_price']).strip()),
+                tax_class_id=self.tax_classes[tax_class],
+                tax_included=(_parse_bool(tax_included) if tax_included != u''
+                    else plata.settings.PLATA_PRICE_INCLUDES_TAX),
+                is_sale=_parse_bool(row.get('is_sale', False)),
+                valid_from=valid_from and _parse_date(valid_from) or self.today,
+                valid_until=valid_until and _parse_date(valid_until) or None,
+                min_quantity=min_quantity != u'' and int(min_quantity) or 1,
+                )
+        except (KeyError, ValueError, InvalidOperation), e:
+            raise PriceImportError(u'Invalid price row %r: %s' % (row, e))
+
+
+def supersede_prices(prices, until_id=None):
+    """
+    Retires active prices superseded by the given, unsaved prices with
+    one ``UPDATE`` per distinct currency, type, minimum quantity and start
+    of validity. Only prices with primary keys up to ``until_id`` are
+    retired if it is given.
+    """
+    groups = {}
+    for price in prices:
+        groups.setdefault((price.currency, price.is_sale, price.min_quantity,
+            price.valid_from), set()).add(price.product_id)
+
+    for (currency, is_sale, min_quantity, valid_from), product_ids in groups.items():
+        superseded = ProductPrice.objects.filter(
+            product__in=product_ids,
+            currency=currency,
+            is_sale=is_sale,
+            min_quantity=min_quantity,
+            is_active=True,
+            )
+        if until_id is not None:
+            superseded = superseded.filter(id__lte=until_id)
+
+        superseded.filter(valid_from=valid_from).update(is_active=False)
+        superseded.filter(
+            Q(valid_until__isnull=True) | Q(valid_until__gte=valid_from),
+            valid_from__lt=valid_from,
+            ).update(valid_until=valid_from - timedelta(days=1))
+
+
+def supersede_imported_prices(since_id, batch_size=500):
+    """
+    Lets the prices with primary keys greater than ``since_id`` supersede
+    each other: Of prices starting the same day only the newest one stays
+    active, and prices are ended the day before the next price starts
+
+    Prices are walked ordered by their group and start of validity, so each
+    one only has to be compared with its predecessor; updates are flushed
+    per batch.
+    """
+    rows = ProductPrice.objects.filter(id__gt=since_id, is_active=True).order_by(
+        'product', 'currency', 'is_sale', 'min_quantity', 'valid_from', 'id',
+        ).values_list('id', 'product', 'currency', 'is_sale', 'min_quantity',
+        'valid_from', 'valid_until').iterator()
+
+    previous = None
+    for chunk in chunked(rows, batch_size):
+        deactivate = {}
+        valid_until = {}
+        for row in chunk:
+            if previous is not None and previous[1:5] == row[1:5]:
+                pk, valid_from, until = previous[0], previous[5], previous[6]
+                if row[5] == valid_from:
+                    deactivate[pk] = False
+                elif until is None or until >= row[5]:
+                    valid_until[pk] = row[5] - timedelta(days=1)
+            previous = row
+
+        bulk_update(ProductPrice, 'is_active', deactivate)
+        bulk_update(ProductPrice, 'valid_until', valid_until)
+
+
+@deferred_invalidation()
+@transaction.commit_on_success
+def import_prices(rows, batch_size=500, supersede=True):
+    """
+    Imports prices from an iterable of rows (see module docstring) in a
+    single transaction
+
+    Rows referencing unknown SKUs are skipped; invalid rows abort the import
+    with a ``PriceImportError``. If multiple rows describe the same product,
+    currency, type, minimum quantity and start of validity, the last one
+    wins.
+
+    Returns a dictionary containing the number of ``imported`` prices and
+    the set of ``unknown_skus``.
+    """
+    parse = PriceRowParser()
+    result = {'imported': 0, 'unknown_skus': set()}
+
+    # Prices created by this import have greater primary keys
+    last_id = ProductPrice.objects.aggregate(last=Max('id')).get('last') or 0
+
+    for batch in chunked(rows, batch_size):
+        skus = dict(Product.objects.filter(
+            sku__in=set(row.get('sku') for row in batch)).order_by().values_list(
+            'sku', 'id'))
+
+        prices = {}
+        for row in batch:
+            product_id = skus.get(row.get('sku'))
+            if product_id is None:
+                result['unknown_skus'].add(row.get('sku'))
+                continue
+
+            price = parse(row, product_id)
+            prices[(price.product_id, price.currency, price.is_sale,
+                price.min_quantity, price.valid_from)] = price
+
+        if not prices:
+            continue
+
+        if supersede:
+            supersede_prices(prices.values(), until_id=last_id)
+        bulk_insert(ProductPrice, prices.values(), batch_size=batch_size)
+        invalidate_product_prices(set(skus.values()))
+
+        result['imported'] += len(prices)
+
+    if supersede and result['imported']:
+        supersede_imported_prices(last_id, batch_size)
+
+    return result
@@ -0,0 +1,12 @@
+from django.contrib import admin
+
+from . import models
+
+
+admin.site.register(models.StockSnapshot,
+    list_display=('variation', 'period', 'items_in_stock', 'last_transaction_id',
+        'created'),
+    list_filter=('period',),
+    raw_id_fields=('variation',),
+    search_fields=('variation__sku',),
+    )
@@ -0,0 +1,29 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from options_product.snapshots.models import SNAPSHOT_DELAY, StockSnapshot
+
+
+class Command(NoArgsCommand):
+    help = ('Creates or advances the stock snapshots of all product variations'
+        ' in the current period.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=500,
+            help='Number of variations processed per transaction. Defaults to 500.'),
+        make_option('--delay', action='store', dest='delay',
+            type='int', default=SNAPSHOT_DELAY,
+            help='Only include stock transactions older than this many seconds.'
+                ' Defaults to %s.' % SNAPSHOT_DELAY),
+        )
+
+    def handle_noargs(self, **options):
+        written = StockSnapshot.objects.create_snapshots(
+            batch_size=options.get('batch_size'),
+            delay=options.get('delay'))
+
+        if int(options.get('verbosity', 1)):
+            sys.stdout.write('%s stock snapshots written.\n' % written)
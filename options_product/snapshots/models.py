@@ -0,0 +1,242 @@
+"""
+Periodic stock snapshots
+
+The stock of a variation is the sum of all its stock transactions in the
+current period, and plata recomputes this sum whenever a stock transaction
+is saved. Snapshots store the sum of the transactions up to a given
+transaction per variation, so that only newer transactions have to be
+summed. Add ``'options_product.snapshots'`` to ``INSTALLED_APPS`` after
+``'plata.product.stock'`` and run the ``snapshot_stock`` management command
+periodically, f.e. every night.
+
+Payment process reservations expire after a few minutes and are therefore
+never included in snapshots; all unexpired reservations are summed
+separately. Changing or deleting a transaction which is already included
+in a snapshot discards the snapshot of the variation until the next run.
+"""
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import Max, Q, Sum, signals
+from django.utils.translation import ugettext_lazy as _
+
+import plata
+from plata.product.stock import models as stock_models
+from plata.product.stock.models import Period, StockTransaction
+from plata.shop.models import Order
+
+from options_product.models import ProductVariation, \
+    flush_stock_transaction_stock_cache
+from options_product.utils import bulk_insert, bulk_update, chunked
+
+
+#: Only transactions older than this many seconds are included in snapshots,
+#: so that transactions which are still being committed are not skipped
+SNAPSHOT_DELAY = getattr(settings, 'OPTIONS_PRODUCT_SNAPSHOT_DELAY', 600)
+
+
+class StockSnapshotManager(models.Manager):
+    def items_in_stock(self, product, update=False, exclude_order=None):
+        """
+        Drop-in replacement for ``StockTransaction.objects.items_in_stock``
+        which only sums the transactions after the snapshot of the variation
+        """
+        variation_id = getattr(product, 'pk', product)
+        period = Period.objects.current()
+
+        queryset = StockTransaction.objects.filter(period=period,
+            product=variation_id).filter(~StockTransaction.objects._expired())
+        count = 0
+
+        try:
+            snapshot = self.get(variation=variation_id, period=period)
+        except self.model.DoesNotExist:
+            snapshot = None
+        else:
+            count = snapshot.items_in_stock
+            covered = Q(id__lte=snapshot.last_transaction_id) & ~Q(
+                type=StockTransaction.PAYMENT_PROCESS_RESERVATION)
+            if exclude_order:
+                # Transactions of the order contained in the snapshot
+                count -= queryset.filter(covered, order=exclude_order).aggregate(
+                    items=Sum('change')).get('items') or 0
+            queryset = queryset.filter(~covered)
+
+        if exclude_order:
+            update = False
+            queryset = queryset.filter(Q(order__isnull=True) | ~Q(order=exclude_order))
+
+        count += queryset.aggregate(items=Sum('change')).get('items') or 0
+
+        if isinstance(product, ProductVariation):
+            product.items_in_stock = count
+
+        if update:
+            ProductVariation.objects.filter(pk=variation_id).update(
+                items_in_stock=count)
+
+        return count
+
+    def items_in_stock_bulk(self, variation_ids):
+        """
+        Returns a dictionary mapping the primary keys of the given variations
+        to their stock like ``items_in_stock``, with two queries per batch of
+        variations
+        """
+        period = Period.objects.current()
+        counts = {}
+        for chunk in chunked(variation_ids, 500):
+            snapshots = {}
+            for variation_id, last_transaction_id, items_in_stock in self.filter(
+                    period=period, variation__in=chunk).values_list(
+                    'variation', 'last_transaction_id', 'items_in_stock'):
+                snapshots[variation_id] = last_transaction_id
+                counts[variation_id] = items_in_stock
+
+            since = min([snapshots.get(pk, 0) for pk in chunk])
+            for variation_id, transaction_id, kind, change in StockTransaction.objects.filter(
+                    period=period,
+                    product__in=chunk,
+                    ).filter(~StockTransaction.objects._expired()).filter(
+                    Q(id__gt=since) | Q(type=StockTransaction.PAYMENT_PROCESS_RESERVATION)
+                    ).order_by().values_list('product', 'id', 'type', 'change'):
+                if (transaction_id > snapshots.get(variation_id, 0)
+                        or kind == StockTransaction.PAYMENT_PROCESS_RESERVATION):
+                    counts[variation_id] = counts.get(variation_id, 0) + change
+
+        for variation_id in variation_ids:
+            counts.setdefault(variation_id, 0)
+        return counts
+
+    def create_snapshots(self, batch_size=500, delay=SNAPSHOT_DELAY):
+        """
+        Creates or advances the snapshots of all variations in the current
+        period to the newest transaction older than ``delay`` seconds, one
+        transaction per batch of variations. Only transactions newer than
+        the existing snapshots of a batch are read. Returns the number of
+        snapshots written.
+        """
+        period = Period.objects.current()
+        last_transaction_id = StockTransaction.objects.filter(period=period,
+            created__lt=datetime.now() - timedelta(seconds=delay)).aggregate(
+            last=Max('id')).get('last')
+        if not last_transaction_id:
+            return 0
+
+        written = 0
+        last_variation_id = 0
+        process = transaction.commit_on_success(self._create_snapshots)
+        while True:
+            variation_ids = list(ProductVariation.objects.filter(
+                pk__gt=last_variation_id).order_by('pk').values_list(
+                'pk', flat=True)[:batch_size])
+            if not variation_ids:
+                return written
+
+            written += process(period, variation_ids, last_transaction_id)
+            last_variation_id = variation_ids[-1]
+
+    def _create_snapshots(self, period, variation_ids, last_transaction_id):
+        snapshots = dict((snapshot.variation_id, snapshot) for snapshot in
+            self.filter(period=period, variation__in=variation_ids))
+
+        # Transactions older than the oldest snapshot of the batch are not
+        # read at all
+        since = min([getattr(snapshots.get(pk), 'last_transaction_id', 0)
+            for pk in variation_ids])
+
+        changes = {}
+        for variation_id, transaction_id, change in StockTransaction.objects.filter(
+                period=period,
+                product__in=variation_ids,
+                id__gt=since,
+                id__lte=last_transaction_id,
+                ).exclude(type=StockTransaction.PAYMENT_PROCESS_RESERVATION).order_by(
+                ).values_list('product', 'id', 'change'):
+            snapshot = snapshots.get(variation_id)
+            if snapshot is None or transaction_id > snapshot.last_transaction_id:
+                changes[variation_id] = changes.get(variation_id, 0) + change
+
+        new = []
+        items_in_stock = {}
+        for variation_id in variation_ids:
+            snapshot = snapshots.get(variation_id)
+            if snapshot is None:
+                new.append(self.model(period=period, variation_id=variation_id,
+                    items_in_stock=changes.get(variation_id, 0),
+                    last_transaction_id=last_transaction_id,
+                    created=datetime.now()))
+            elif snapshot.last_transaction_id < last_transaction_id:
+                items_in_stock[snapshot.pk] = (snapshot.items_in_stock
+                    + changes.get(variation_id, 0))
+
+        bulk_insert(self.model, new)
+        bulk_update(self.model, 'items_in_stock', items_in_stock)
+        bulk_update(self.model, 'last_transaction_id', dict(
+            (pk, last_transaction_id) for pk in items_in_stock))
+        bulk_update(self.model, 'created', dict(
+            (pk, datetime.now()) for pk in items_in_stock))
+        return len(new) + len(items_in_stock)
+
+
+class StockSnapshot(models.Model):
+    """
+    Sum of the stock transactions of a variation in a period up to and
+    including ``last_transaction_id``, excluding payment process
+    reservations
+    """
+
+    period = models.ForeignKey(Period, related_name='stock_snapshots',
+        verbose_name=_('period'))
+    variation = models.ForeignKey(ProductVariation, related_name='stock_snapshots',
+        verbose_name=_('product variation'))
+    created = models.DateTimeField(_('created'), default=datetime.now)
+    items_in_stock = models.IntegerField(_('items in stock'))
+    last_transaction_id = models.PositiveIntegerField(_('last transaction ID'))
+
+    class Meta:
+        unique_together = (('period', 'variation'),)
+        verbose_name = _('stock snapshot')
+        verbose_name_plural = _('stock snapshots')
+
+    objects = StockSnapshotManager()
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.variation, self.items_in_stock)
+
+
+def update_items_in_stock(instance, created=False, **kwargs):
+    if not created:
+        # Snapshots including the transaction are outdated now
+        StockSnapshot.objects.filter(variation=instance.product_id,
+            last_transaction_id__gte=instance.pk).delete()
+    StockSnapshot.objects.items_in_stock(instance.product_id, update=True)
+
+
+def validate_order_stock_available(order):
+    """Check whether enough stock is available for all selected products"""
+    for item in order.items.all().select_related('product'):
+        if item.quantity > StockSnapshot.objects.items_in_stock(item.product,
+                exclude_order=order):
+            raise ValidationError(
+                _('Not enough stock available for %s.') % item.product,
+                code='insufficient_stock')
+
+
+if plata.settings.PLATA_STOCK_TRACKING:
+    # Replace the stock computations of plata.product.stock. The stock cache
+    # has to be invalidated after items_in_stock has been updated, otherwise
+    # other processes could cache the old stock again.
+    for signal in (signals.post_save, signals.post_delete):
+        signal.disconnect(stock_models.update_items_in_stock, sender=StockTransaction)
+        signal.disconnect(flush_stock_transaction_stock_cache, sender=StockTransaction)
+        signal.connect(update_items_in_stock, sender=StockTransaction)
+        signal.connect(flush_stock_transaction_stock_cache, sender=StockTransaction)
+
+    validators = Order.VALIDATORS.get(Order.VALIDATE_CART, [])
+    if stock_models.validate_order_stock_available in validators:
+        validators[validators.index(stock_models.validate_order_stock_available)] = \
+            validate_order_stock_available
@@ -0,0 +1,46 @@
+"""
+Releasing expired reservations in bulk
+
+Cart reservations (``StockReservation``) and plata's payment process
+reservations (``StockTransaction.PAYMENT_PROCESS_RESERVATION``) expire, but
+nothing removes them: Expired cart reservations keep counting towards
+``items_reserved``, and the ``items_in_stock`` field of a variation still
+includes expired payment process reservations until another stock
+transaction of the variation is saved. Run the ``release_reservations``
+management command periodically, f.e. every few minutes, to release both.
+"""
+
+from django.conf import settings
+from django.db import transaction
+
+from options_product.models import invalidate_product_stock, recount_items_in_stock
+from options_product.utils import bulk_delete, chunked
+
+
+def sweep_payment_reservations(batch_size=500):
+    """
+    Deletes all expired payment process reservations and recomputes the
+    ``items_in_stock`` field of the affected variations, yielding the number
+    of reservations deleted per batch. Does nothing if
+    ``plata.product.stock`` is not installed.
+    """
+    if 'plata.product.stock' not in settings.INSTALLED_APPS:
+        return
+
+    from plata.product.stock.models import StockTransaction
+
+    rows = list(StockTransaction.objects.expired().order_by('product').values_list(
+        'id', 'product', 'product__product'))
+
+    release = transaction.commit_on_success(_release_payment_reservations)
+    for chunk in chunked(rows, batch_size):
+        yield release(chunk)
+
+
+def _release_payment_reservations(rows):
+    from plata.product.stock.models import StockTransaction
+
+    deleted = bulk_delete(StockTransaction, [row[0] for row in rows])
+    recount_items_in_stock(set(row[1] for row in rows))
+    invalidate_product_stock(set(row[2] for row in rows))
+    return deleted
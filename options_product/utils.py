@@ -0,0 +1,160 @@
+"""
+Helpers for set-based database writes
+"""
+
+from itertools import islice
+
+from django.db import connections, models, router, transaction
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of at most ``size`` items from ``iterable`` without
+    consuming more of it than necessary
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bulk_insert(model, objects, batch_size=500):
+    """
+    Inserts unsaved model instances with one multi-row statement per batch
+
+    Neither ``save()`` nor ``pre_save`` / ``post_save`` signals are run, and
+    primary keys are not set on the instances passed. Uses
+    ``QuerySet.bulk_create`` if the installed version of Django has it.
+    """
+    manager = model._default_manager
+    if hasattr(manager, 'bulk_create'):
+        for chunk in chunked(objects, batch_size):
+            manager.bulk_create(chunk)
+        return
+
+    using = router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    fields = [f for f in model._meta.local_fields
+        if not isinstance(f, models.AutoField)]
+    sql = u'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table),
+        u', '.join(qn(f.column) for f in fields),
+        u', '.join([u'%s'] * len(fields)),
+        )
+
+    cursor = connection.cursor()
+    for chunk in chunked(objects, batch_size):
+        cursor.executemany(sql, [
+            [f.get_db_prep_save(f.pre_save(obj, True), connection=connection)
+                for f in fields]
+            for obj in chunk])
+
+    # Raw cursor writes do not mark the transaction as dirty
+    transaction.set_dirty(using=using)
+
+
+def bulk_update(model, field_name, values, batch_size=250):
+    """
+    Updates one field of many rows at once. ``values`` maps primary keys
+    to the new values; every batch is written with a single
+    ``UPDATE ... SET field = CASE pk WHEN ... END`` statement.
+
+    Neither ``save()`` nor any signals are run.
+    """
+    values = values.items()
+    if not values:
+        return
+
+    using = router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    field = model._meta.get_field(field_name)
+    pk = qn(model._meta.pk.column)
+
+    cursor = connection.cursor()
+    for chunk in chunked(values, batch_size):
+        params = []
+        for key, value in chunk:
+            params.extend((key, field.get_db_prep_save(value, connection=connection)))
+        params.extend(key for key, value in chunk)
+
+        cursor.execute(u'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+            qn(model._meta.db_table),
+            qn(field.column),
+            pk,
+            u' '.join([u'WHEN %s THEN %s'] * len(chunk)),
+            pk,
+            u', '.join([u'%s'] * len(chunk)),
+            ), params)
+
+    transaction.set_dirty(using=using)
+
+
+def bulk_increment(model, field_name, deltas, batch_size=250):
+    """
+    Adds the values of ``deltas``, a dictionary mapping primary keys to
+    numbers, to one field of many rows. Unlike ``bulk_update`` the change is
+    applied relative to the current value in the database, so concurrent
+    increments are not lost.
+
+    Neither ``save()`` nor any signals are run.
+    """
+    deltas = [(key, delta) for key, delta in deltas.items() if delta]
+    if not deltas:
+        return
+
+    using = router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    column = qn(model._meta.get_field(field_name).column)
+    pk = qn(model._meta.pk.column)
+
+    cursor = connection.cursor()
+    for chunk in chunked(deltas, batch_size):
+        params = []
+        for key, delta in chunk:
+            params.extend((key, delta))
+        params.extend(key for key, delta in chunk)
+
+        cursor.execute(u'UPDATE %s SET %s = %s + CASE %s %s END WHERE %s IN (%s)' % (
+            qn(model._meta.db_table),
+            column,
+            column,
+            pk,
+            u' '.join([u'WHEN %s THEN %s'] * len(chunk)),
+            pk,
+            u', '.join([u'%s'] * len(chunk)),
+            ), params)
+
+    transaction.set_dirty(using=using)
+
+
+def bulk_delete(model, pks, batch_size=500):
+    """
+    Deletes rows by primary key without loading them and returns the number
+    of rows deleted, which may be less than the number of primary keys passed
+    if other transactions deleted some of the rows first
+
+    Neither ``delete()`` nor any signals are run, and related objects are
+    not collected.
+    """
+    using = router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    deleted = 0
+    cursor = connection.cursor()
+    for chunk in chunked(pks, batch_size):
+        cursor.execute(u'DELETE FROM %s WHERE %s IN (%s)' % (
+            qn(model._meta.db_table),
+            qn(model._meta.pk.column),
+            u', '.join([u'%s'] * len(chunk)),
+            ), chunk)
+        deleted += cursor.rowcount
+
+    transaction.set_dirty(using=using)
+    return deleted
@@ -4,12 +4,17 @@ from django import forms
 from django.contrib import messages
 from django.core.exceptions import ValidationError
 from django.db.models import ObjectDoesNotExist
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.shortcuts import redirect, render_to_response
 from django.template import RequestContext
+from django.utils import simplejson
 from django.utils.translation import ugettext as _
 
 import plata
 
+from options_product.caching import local_cache, option_cache
+from options_product.models import Option, StockReservation
+
 
 logger = logging.getLogger('options_product.views')
 
@@ -42,7 +47,7 @@ class ProductView(object):
 
         if request.method == 'POST':
             order = self.shop.order_from_request(request, create=True)
-            form = OrderItemForm(request.POST, order=order)
+            form = OrderItemForm(request.POST, order=order, product=product)
 
             if form.is_valid():
                 try:
@@ -52,16 +57,20 @@ class ProductView(object):
                         )
                     messages.success(request, _('The cart has been updated.'))
                 except ValidationError, e:
+                    form.cancel_reservation()
                     if e.code == 'order_sealed':
                         [messages.error(request, msg) for msg in e.messages]
                     else:
                         raise
+                except Exception:
+                    form.cancel_reservation()
+                    raise
 
                 order.recalculate_total()
 
                 return self.shop.redirect(redirect_to)
         else:
-            form = OrderItemForm()
+            form = OrderItemForm(product=product)
 
         context = context or {}
         context.update({
@@ -71,69 +80,153 @@ class ProductView(object):
 
         return self.shop.render(request, template_name, context)
 
+    def option_availability(self, request, product):
+        """
+        Returns the ``AvailabilityIndex`` of the product as JSON, together
+        with the options which can be chosen together with the options
+        passed as ``option`` query parameters. Options only available
+        without stock are listed in ``available``, but not in
+        ``available_in_stock``.
+        """
+        availability = product.option_availability()
+        try:
+            selection = [int(pk) for pk in request.GET.getlist('option')]
+        except ValueError:
+            return HttpResponseBadRequest()
+
+        data = availability.describe()
+        data.update({
+            'available': sorted(availability.available_options(selection)),
+            'available_in_stock': sorted(availability.available_options(
+                selection, in_stock=True)),
+            })
+        return HttpResponse(simplejson.dumps(data), mimetype='application/json')
+
     def order_modify_item_form(self, request, product):
         """
         Returns a form subclass which is used in ``product_detail`` above
         to handle cart changes on the product detail page.
+
+        Form classes are built from the cached ``Product.option_schema``
+        and reused until the schema changes. Pass the product as ``product``
+        keyword argument when instantiating the form, otherwise it is
+        loaded again.
+
+        Validating a form with an ``order`` reserves the items for the order.
+        Call ``cancel_reservation`` if the order item is not modified
+        afterwards.
         """
+        schema_key = product.option_schema_key()
+        if option_cache.is_pending(schema_key):
+            return self._build_order_modify_item_form(product)
+
+        key = 'order-item-form-%s' % schema_key
+        Form = local_cache.get(key)
+        if Form is None:
+            Form = self._build_order_modify_item_form(product)
+            local_cache.set(key, Form)
+        return Form
+
+    def _build_order_modify_item_form(self, product):
+        product_model = product.__class__
+        product_id = product.pk
+        schema = product.option_schema()
 
         class Form(forms.Form):
             quantity = forms.IntegerField(label=_('quantity'), initial=1)
 
             def __init__(self, *args, **kwargs):
                 self.order = kwargs.pop('order', None)
+                self.reservation = None
+                self.product = kwargs.pop('product', None)
+                if self.product is None:
+                    self.product = product_model._default_manager.get(pk=product_id)
 
                 super(Form, self).__init__(*args, **kwargs)
-                for group in product.option_groups.all():
-                    self.fields['option_%s' % group.id] = forms.ModelChoiceField(
-                        queryset=group.options.filter(
-                            variations__is_active=True,
-                            variations__product=product).distinct(),
-                        label=group.name)
+                self.availability = self.product.option_availability()
+                available = self.availability.available_options()
+                for group_id, name, choices in schema:
+                    if not self.product.sparse_variations:
+                        # Only offer options of active variations. Variations
+                        # of sparse products are created on demand.
+                        choices = [(pk, option_name) for pk, option_name in choices
+                            if pk in available]
+
+                    self.fields['option_%s' % group_id] = forms.TypedChoiceField(
+                        choices=[(u'', u'---------')] + choices, coerce=int,
+                        label=name)
 
             def clean(self):
                 data = super(Form, self).clean()
+                product = self.product
 
-                options = [data.get('option_%s' % group.id) for group in product.option_groups.all()]
-
-                if not all(options):
+                fields = ['option_%s' % group_id for group_id, name, choices in schema]
+                if not all(data.get(field) for field in fields):
                     # If we do not have values for all options, the form will not
                     # validate and we cannot retrieve a variation.
                     return data
 
-                variations = product.variations.filter(is_active=True)
-
-                for group in product.option_groups.all():
-                    variations = variations.filter(options=self.cleaned_data.get('option_%s' % group.id))
+                options = Option.objects.in_bulk([data[field] for field in fields])
+                options = [options.get(data[field]) for field in fields]
+                if not all(options):
+                    # Options deleted after the schema has been cached
+                    raise forms.ValidationError(_('The requested product does not exist.'))
+                data.update(zip(fields, options))
 
                 try:
-                    data['variation'] = variations.get()
+                    variation = product.variation_for_options(options)
+                    if not variation.is_active:
+                        raise ObjectDoesNotExist
+                    data['variation'] = variation
                 except ObjectDoesNotExist:
                     logger.warn('Product variation of %s with options %s does not exist' % (
                         product, options))
                     raise forms.ValidationError(_('The requested product does not exist.'))
 
+                # Determine the price before reserving anything
+                try:
+                    try:
+                        data['price'] = variation.get_price(
+                            currency=self.order.currency, **data)
+                    except TypeError:
+                        data['price'] = variation.get_price(
+                            currency=self.order.currency)
+
+                except ObjectDoesNotExist:
+                    raise forms.ValidationError(_('Price could not be determined.'))
+
                 quantity = new_quantity = data.get('quantity')
                 variation = data.get('variation')
 
                 if quantity and variation:
+                    old_quantity = 0
                     if self.order:
                         try:
                             orderitem = self.order.items.get(product=variation)
                             old_quantity = orderitem.quantity
                             new_quantity += orderitem.quantity
                         except ObjectDoesNotExist:
-                            old_quantity = 0
-
-                    dic = {
-                        'stock': variation.items_in_stock,
-                        'variation': variation,
-                        'quantity': old_quantity,
-                        }
-                    available = variation.stock_transactions.items_in_stock(variation, # FIXME hardcoded
-                        exclude_order=self.order)
+                            pass
+
+                        # Hold the items for this cart; the counters of the
+                        # variation guard against overselling
+                        reserved = StockReservation.objects.reserve(
+                            variation, self.order, new_quantity)
+                        if reserved:
+                            self.reservation = (variation, old_quantity)
+                    else:
+                        reserved = new_quantity <= (
+                            variation.items_in_stock - variation.items_reserved)
+
+                    if not reserved:
+                        available = StockReservation.objects.available(
+                            variation, self.order)
+                        dic = {
+                            'stock': available,
+                            'variation': variation,
+                            'quantity': old_quantity,
+                            }
 
-                    if new_quantity > available:
                         if not available:
                             self._errors['quantity'] = self.error_class([
                                 _('No items of %(variation)s on stock.') % dic])
@@ -144,16 +237,15 @@ class ProductView(object):
                             self._errors['quantity'] = self.error_class([
                                 _('Only %(stock)s items for %(variation)s available.') % dic])
 
-                try:
-                    try:
-                        data['price'] = variation.get_price(
-                            currency=self.order.currency, **data)
-                    except TypeError:
-                        data['price'] = variation.get_price(
-                            currency=self.order.currency)
-
-                except ObjectDoesNotExist:
-                    raise forms.ValidationError(_('Price could not be determined.'))
-
                 return data
+
+            def cancel_reservation(self):
+                """
+                Returns the reservation made while validating the form to
+                the quantity of the order item
+                """
+                if self.reservation:
+                    variation, quantity = self.reservation
+                    StockReservation.objects.reserve(variation, self.order, quantity)
+                    self.reservation = None
         return Form